@@ -35,11 +35,24 @@ import sys
 import binascii
 import re
 import glob
-from time import sleep
+from time import sleep, perf_counter, monotonic
 import codecs
 import os.path
 import threading
 import array
+import bisect
+import hashlib
+import io
+import selectors
+import select
+import struct
+import queue
+import gzip
+import atexit
+import json
+import logging
+import shutil
+from urllib.parse import urlparse, parse_qsl
 
 import serial
 from serial.tools.list_ports import comports
@@ -71,8 +84,6 @@ EMC_EXECUTE_FLASH_COMMAND = '0B'
 EMC_BOARD_INFO_COMMAND = '0C'
 EMC_UPDATE_COMMAND = '0D'
 
-Board_Type = '0'
-
 # pylint: disable=wrong-import-order,wrong-import-position
 
 codecs.register(lambda c: hexlify_codec.getregentry()
@@ -202,12 +213,18 @@ elif os.name == 'posix':
             super(Console, self).__init__()
             self.fd = sys.stdin.fileno()
             self.old = termios.tcgetattr(self.fd)
+            # cancel() writes to this pipe to wake getkey() or a selector
+            self.wake_fd, self._wake_w = os.pipe()
+            os.set_blocking(self.wake_fd, False)
+            os.set_blocking(self._wake_w, False)
             atexit.register(self.cleanup)
             if sys.version_info < (3, 0):
                 self.enc_stdin = codecs.getreader(
                     sys.stdin.encoding)(sys.stdin)
             else:
                 self.enc_stdin = sys.stdin
+            self.key_decoder = codecs.getincrementaldecoder(
+                sys.stdin.encoding or 'UTF-8')('replace')
 
         def setup(self):
             new = termios.tcgetattr(self.fd)
@@ -217,14 +234,43 @@ elif os.name == 'posix':
             termios.tcsetattr(self.fd, termios.TCSANOW, new)
 
         def getkey(self):
-            c = self.enc_stdin.read(1)
+            """the next key, None once cancel() was called"""
+            c = ''
+            while not c:
+                ready = select.select([self.fd, self.wake_fd], [], [])[0]
+                if self.wake_fd in ready:
+                    self.drain_wake()
+                    return None
+                data = os.read(self.fd, 1)
+                if not data:
+                    # end of input, only a cancel() can follow
+                    select.select([self.wake_fd], [], [])
+                    self.drain_wake()
+                    return None
+                c = self.key_decoder.decode(data)
             if c == unichr(0x7f):
                 # map the BS key (which yields DEL) to backspace
                 c = unichr(8)
             return c
 
+        def drain_wake(self):
+            try:
+                while os.read(self.wake_fd, 1024):
+                    pass
+            except BlockingIOError:
+                pass
+
+        def read_keys(self):
+            """read the keys that are available, for use with a selector"""
+            text = self.key_decoder.decode(os.read(self.fd, 1024))
+            # map the BS key (which yields DEL) to backspace
+            return text.replace(unichr(0x7f), unichr(8))
+
         def cancel(self):
-            fcntl.ioctl(self.fd, termios.TIOCSTI, b'\0')
+            try:
+                os.write(self._wake_w, b'x')
+            except BlockingIOError:
+                pass
 
         def cleanup(self):
             termios.tcsetattr(self.fd, termios.TCSAFLUSH, self.old)
@@ -233,12 +279,39 @@ else:
     raise NotImplementedError(
         'Sorry no implementation for your platform ({}) available.'.format(sys.platform))
 
+
+class HeadlessConsole(ConsoleBase):
+    """\
+    Console for runs without a terminal on stdin, e.g. in CI: received data
+    is written to stdout, there are no keys. getkey() waits for cancel().
+    """
+
+    def __init__(self):
+        super(HeadlessConsole, self).__init__()
+        self._cancelled = threading.Event()
+
+    def getkey(self):
+        self._cancelled.wait()
+        self._cancelled.clear()
+        return None
+
+    def cancel(self):
+        self._cancelled.set()
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
 class Transform(object):
     """do-nothing: forward all data unchanged"""
 
+    # rx() maps every character on its own, independent of its neighbours,
+    # so it can be folded into a single translation table. Set to False
+    # for transformations that work on the whole chunk.
+    rx_charwise = True
+    # text that a non charwise rx() puts in front of every chunk, if that
+    # is all it does
+    rx_prefix = None
+
     def rx(self, text):
         """text received from serial port"""
         return text
@@ -324,11 +397,17 @@ class Printable(Transform):
 class Colorize(Transform):
     """Apply different colors for received and echo"""
 
+    rx_charwise = False
+
     def __init__(self):
         # XXX make it configurable, use colorama?
         self.input_color = '\x1b[37m'
         self.echo_color = '\x1b[31m'
 
+    @property
+    def rx_prefix(self):
+        return self.input_color
+
     def rx(self, text):
         return self.input_color + text
 
@@ -339,6 +418,8 @@ class Colorize(Transform):
 class DebugIO(Transform):
     """Print what is sent and received"""
 
+    rx_charwise = False
+
     def rx(self, text):
         sys.stderr.write(' [RX:{}] '.format(repr(text)))
         sys.stderr.flush()
@@ -350,6 +431,72 @@ class DebugIO(Transform):
         return text
 
 
+class RxTable(dict):
+    """\
+    str.translate table for a chain of charwise transformations. The
+    result for a character is computed by running it through the chain the
+    first time it is seen and remembered afterwards.
+    """
+
+    def __init__(self, transformations):
+        super(RxTable, self).__init__()
+        self.transformations = transformations
+
+    def __missing__(self, key):
+        text = unichr(key)
+        for transformation in self.transformations:
+            text = transformation.rx(text)
+        self[key] = text
+        return text
+
+
+def compile_rx(transformations):
+    """\
+    Fold the rx side of a list of transformations into one function that
+    handles a received chunk in as few passes as possible: consecutive
+    charwise transformations become one translation table, prefixes (e.g.
+    colors) are applied once, anything else is called as is.
+    """
+    stages = []
+    chain = []
+    prefix = ''
+
+    def flush(chain, prefix):
+        if chain:
+            table = RxTable(chain)
+            if prefix:
+                stages.append(lambda text: prefix + text.translate(table))
+            else:
+                stages.append(lambda text: text.translate(table))
+        elif prefix:
+            stages.append(lambda text: prefix + text)
+
+    for transformation in transformations:
+        if transformation.rx_charwise:
+            if type(transformation).rx is not Transform.rx:
+                chain.append(transformation)
+                prefix = transformation.rx(prefix)
+        elif transformation.rx_prefix is not None:
+            prefix = transformation.rx_prefix + prefix
+        else:
+            flush(chain, prefix)
+            chain = []
+            prefix = ''
+            stages.append(transformation.rx)
+    flush(chain, prefix)
+
+    if not stages:
+        return lambda text: text
+    if len(stages) == 1:
+        return stages[0]
+
+    def rx(text):
+        for stage in stages:
+            text = stage(text)
+        return text
+    return rx
+
+
 # other ideas:
 # - add date/time for each newline
 # - insert newline after: a) timeout b) packet end character
@@ -399,15 +546,246 @@ def serial_ports():
     return result
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# session log
+
+# timestamped logs start with LOG_MAGIC followed by LOG_RECORD headers
+# (direction b'R'/b'T', seconds since the session start, data length),
+# each followed by the data itself
+LOG_MAGIC = b'WDCTRC1\n'
+LOG_RECORD = struct.Struct('<cdI')
+
+
+def parse_size(text):
+    """parse a byte count with an optional K, M or G suffix"""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text, 0)
+
+
+class SessionLog(object):
+    """\
+    Record serial data to a file from a background thread. rx() and tx()
+    only queue the data, they never wait for the disk. When the queue is
+    full the data is counted in dropped instead.
+    """
+
+    def __init__(self, path, tx=False, timestamps=False, max_bytes=0,
+                 backups=5, compress=False, queue_size=16384):
+        self.path = path
+        self.log_tx = tx
+        self.timestamps = timestamps
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.dropped = 0
+        self.start = monotonic()
+        self.queue = queue.Queue(queue_size)
+        self.file = None
+        self.size = 0
+        self._open()
+        self.thread = threading.Thread(target=self._run, name='log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def rx(self, data, stamp=None):
+        """queue data received from the serial port (at monotonic() stamp)"""
+        self._put(b'R', data, stamp)
+
+    def tx(self, data):
+        """queue data sent to the serial port"""
+        if self.log_tx:
+            self._put(b'T', data)
+
+    def _put(self, direction, data, stamp=None):
+        try:
+            self.queue.put_nowait((direction, stamp or monotonic(), bytes(data)))
+        except queue.Full:
+            self.dropped += len(data)
+
+    def close(self):
+        """write out everything queued so far and close the file"""
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def _open(self):
+        self.file = open(self.path, 'wb')
+        self.size = 0
+        if self.timestamps:
+            self.file.write(LOG_MAGIC)
+            self.size = len(LOG_MAGIC)
+
+    def _rotate(self):
+        self.file.close()
+        suffix = '.gz' if self.compress else ''
+        for i in range(self.backups - 1, 0, -1):
+            name = '%s.%d%s' % (self.path, i, suffix)
+            if os.path.exists(name):
+                os.replace(name, '%s.%d%s' % (self.path, i + 1, suffix))
+        if self.backups < 1:
+            os.remove(self.path)
+        elif self.compress:
+            with open(self.path, 'rb') as src:
+                with gzip.open(self.path + '.1.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.path + '.1')
+        self._open()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            direction, stamp, data = item
+            if self.timestamps:
+                data = LOG_RECORD.pack(direction, stamp - self.start, len(data)) + data
+            if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+                self._rotate()
+            self.file.write(data)
+            self.size += len(data)
+            if self.queue.empty():
+                self.file.flush()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# triggers
+
+def trigger_regex(patterns):
+    """\
+    Combine byte patterns into one multiline regex with the groups t0, t1,
+    ... A leading global flag group like (?i) is scoped to its pattern.
+    Raises re.error.
+    """
+    parts = []
+    for i, pattern in enumerate(patterns):
+        flags = re.match(br'\(\?([aiLmsux]+)\)', pattern)
+        if flags:
+            pattern = b'(?' + flags.group(1) + b':' + pattern[flags.end():] + b')'
+        parts.append(b'(?P<t%d>' % i + pattern + b')')
+    return re.compile(b'|'.join(parts), re.MULTILINE)
+
+
+class TriggerEngine(object):
+    """\
+    Match regular expressions against the received byte stream and call
+    an action for every match. All patterns are combined into one regex
+    (see trigger_regex) and matches may span chunk boundaries: up to window
+    bytes of data that did not match yet are kept for the next chunk, with
+    one byte before them so ^ only matches at the start of a line.
+    """
+
+    def __init__(self, triggers, window=1024):
+        patterns = []
+        self.actions = []
+        for pattern, action in triggers:
+            patterns.append(pattern)
+            self.actions.append(action)
+        self.names = ['t%d' % i for i in range(len(patterns))]
+        self.regex = trigger_regex(patterns)
+        self.window = window
+        self.buf = bytearray()
+        self.pos = 0
+
+    def feed(self, data):
+        """scan received data, run the actions of all matches"""
+        self.buf += data
+        fired = []
+        end = self.pos
+        for m in self.regex.finditer(self.buf, self.pos):
+            for name, action in zip(self.names, self.actions):
+                if m.start(name) != -1:
+                    fired.append((action, m.group()))
+                    break
+            end = m.end()
+        keep = max(end, len(self.buf) - self.window)
+        del self.buf[:max(keep - 1, 0)]
+        self.pos = min(keep, 1)
+        for action, text in fired:
+            action(text)
+
+
+def parse_marker(text):
+    """check a time mode marker regex, matched like a trigger pattern"""
+    try:
+        trigger_regex([text.encode('utf-8')])
+    except re.error as e:
+        raise argparse.ArgumentTypeError('invalid regex {!r}: {}'.format(text, e))
+    return text
+
+
+def parse_trigger_action(spec):
+    """\
+    Split a trigger action of the form NAME[:ARGUMENTS] and check it.
+    Returns (name, arguments) or raises ValueError.
+    """
+    name, _, value = spec.partition(':')
+    if name == 'exit':
+        return name, int(value or '0', 0)
+    elif name == 'send':
+        return name, codecs.decode(value, 'unicode_escape')
+    elif name == 'upload':
+        return name, None
+    elif name == 'dump':
+        address, _, length = value.rpartition(':')
+        return name, (parse_address(address), int(length, 0))
+    raise ValueError('unknown trigger action {!r}'.format(spec))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# capture of data received before the terminal starts
+
+class RxCapture(object):
+    """\
+    Read the serial port in a background thread from creation until
+    stop(), so nothing the board sends is delayed or lost while the
+    terminal is set up.
+    """
+
+    def __init__(self, serial_instance):
+        self.serial = serial_instance
+        self.chunks = []
+        self._alive = True
+        self.thread = threading.Thread(target=self._run, name='capture')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while self._alive:
+            data = self.serial.read(self.serial.in_waiting or 1)
+            if data:
+                self.chunks.append((monotonic(), data))
+
+    def stop(self):
+        """stop reading, returns the received chunks as (timestamp, data)"""
+        self._alive = False
+        if hasattr(self.serial, 'cancel_read'):
+            self.serial.cancel_read()
+        self.thread.join()
+        # a read that returned data before the cancel leaves it pending,
+        # it would end the next read early
+        if hasattr(self.serial, 'clear_cancel_read'):
+            self.serial.clear_cancel_read()
+        return self.chunks
+
+
 class Miniterm(object):
     """\
     Terminal application. Copy data from serial port to console and vice versa.
     Handle special keys from the console to show menu etc.
     """
 
-    def __init__(self, serial_instance, echo=False, eol='crlf', filters=()):
-        self.console = Console()
+    def __init__(self, serial_instance, echo=False, eol='crlf', filters=(), log=None,
+                 console=None):
+        self.console = console if console is not None else Console()
         self.serial = serial_instance
+        self.log = log
+        self.triggers = None
+        self.exit_code = 0
         self.echo = echo
         self.raw = False
         self.input_encoding = 'UTF-8'
@@ -418,10 +796,17 @@ class Miniterm(object):
         self.exit_character = 0x1d  # GS/CTRL+]
         self.menu_character = 0x14  # Menu: CTRL+T
         self.alive = None
+        self._menu_active = False
         self._reader_alive = None
         self.receiver_thread = None
         self.rx_decoder = None
         self.tx_decoder = None
+        # received data is coalesced up to this many bytes or seconds
+        # before it is decoded and written to the console
+        self.rx_flush_size = 4096
+        self.rx_flush_time = 0.005
+        # no new data after this many seconds counts as idle input
+        self.rx_idle_gap = 0.001
 
     def _start_reader(self):
         """Start reader thread"""
@@ -453,6 +838,14 @@ class Miniterm(object):
         """set flag to stop worker threads"""
         self.alive = False
 
+    def quit(self, code=0):
+        """stop the terminal from any thread, the program exits with code"""
+        self.exit_code = code
+        running = self.alive
+        self.stop()
+        if running:
+            self.console.cancel()
+
     def join(self, transmit_only=False):
         """wait for worker threads to terminate"""
         self.transmitter_thread.join()
@@ -463,6 +856,11 @@ class Miniterm(object):
 
     def close(self):
         self.serial.close()
+        if self.log is not None:
+            self.log.close()
+            if self.log.dropped:
+                sys.stderr.write('--- log: {} bytes dropped, queue full ---\n'.format(
+                    self.log.dropped))
 
     def update_transformations(self):
         """take list of transformation classes and instantiate them for rx and tx"""
@@ -470,6 +868,7 @@ class Miniterm(object):
                                                              for f in self.filters]
         self.tx_transformations = [t() for t in transformations]
         self.rx_transformations = list(reversed(self.tx_transformations))
+        self.rx_transform = compile_rx(self.rx_transformations)
 
     def set_rx_encoding(self, encoding, errors='replace'):
         """set encoding for received data"""
@@ -510,32 +909,65 @@ class Miniterm(object):
         sys.stderr.write('--- EOL: {}\n'.format(self.eol.upper()))
         sys.stderr.write('--- filters: {}\n'.format(' '.join(self.filters)))
 
+    def handle_rx(self, data, stamp=None):
+        """decode, transform and show data received from the serial port"""
+        if self.log is not None:
+            self.log.rx(data, stamp)
+        if self.raw:
+            self.console.write_bytes(data)
+        else:
+            self.console.write(self.rx_transform(self.rx_decoder.decode(data)))
+        if self.triggers is not None:
+            self.triggers.feed(data)
+
     def reader(self):
-        """loop and copy serial->console"""
+        """\
+        Loop and copy serial->console. Data is collected in a buffer and
+        written out when it reaches rx_flush_size bytes, when a newline
+        arrives, when the input goes idle or rx_flush_time seconds after
+        the first byte at the latest.
+        """
+        buf = bytearray()
         try:
             while self.alive and self._reader_alive:
                 # read all that is there or wait for one byte
                 data = self.serial.read(self.serial.in_waiting or 1)
-                if data:
-                    if self.raw:
-                        self.console.write_bytes(data)
-                    else:
-                        text = self.rx_decoder.decode(data)
-                        for transformation in self.rx_transformations:
-                            text = transformation.rx(text)
-                        self.console.write(text)
+                if not data:
+                    continue
+                buf += data
+                if self.rx_flush_time > 0:
+                    deadline = monotonic() + self.rx_flush_time
+                    while len(buf) < self.rx_flush_size and b'\n' not in data:
+                        waiting = self.serial.in_waiting
+                        if not waiting:
+                            sleep(self.rx_idle_gap)
+                            waiting = self.serial.in_waiting
+                            if not waiting:
+                                break
+                        data = self.serial.read(
+                            min(waiting, self.rx_flush_size - len(buf)))
+                        buf += data
+                        if monotonic() >= deadline:
+                            break
+                self.handle_rx(buf)
+                del buf[:]
         except serial.SerialException:
             self.alive = False
             self.console.cancel()
             raise       # XXX handle instead of re-raise?
 
+    def write_tx(self, data):
+        """send data to the serial port"""
+        self.serial.write(data)
+        if self.log is not None:
+            self.log.tx(data)
+
     def writer(self):
         """\
         Loop and copy console->serial until self.exit_character character is
         found. When self.menu_character is found, interpret the next key
         locally.
         """
-        menu_active = False
         try:
             while self.alive:
                 try:
@@ -544,34 +976,100 @@ class Miniterm(object):
                     c = '\x03'
                 if not self.alive:
                     break
-                if menu_active:
-                    self.handle_menu_key(c)
-                    menu_active = False
-                elif c == self.menu_character:
-                    menu_active = True      # next char will be for menu
-                elif c == self.exit_character:
-                    self.stop()             # exit app
-                    break
-                else:
-                    # ~ if self.raw:
-                    text = c
-                    for transformation in self.tx_transformations:
-                        text = transformation.tx(text)
-                    self.serial.write(self.tx_encoder.encode(text))
-                    if self.echo:
-                        echo_text = c
-                        for transformation in self.tx_transformations:
-                            echo_text = transformation.echo(echo_text)
-                        self.console.write(echo_text)
+                if c is not None:
+                    self.handle_key(c)
         except:
             self.alive = False
             raise
 
+    def handle_key(self, c):
+        """send a key typed on the console or handle it locally"""
+        if self._menu_active:
+            self.handle_menu_key(c)
+            self._menu_active = False
+        elif c == self.menu_character:
+            self._menu_active = True    # next char will be for menu
+        elif c == self.exit_character:
+            self.stop()                 # exit app
+        else:
+            # ~ if self.raw:
+            text = c
+            for transformation in self.tx_transformations:
+                text = transformation.tx(text)
+            self.write_tx(self.tx_encoder.encode(text))
+            if self.echo:
+                echo_text = c
+                for transformation in self.tx_transformations:
+                    echo_text = transformation.echo(echo_text)
+                self.console.write(echo_text)
+
+    def selector_supported(self):
+        """True if run_selector() can be used with this console and port"""
+        if getattr(self.console, 'fd', None) is None:
+            return False
+        try:
+            self.serial.fileno()
+        except (AttributeError, serial.SerialException):
+            return False
+        return True
+
+    def run_selector(self):
+        """\
+        Single threaded alternative to start()/join() for POSIX: wait for
+        the serial port and the console with a selector and copy whatever
+        is ready, until the exit character is typed. Received data is
+        coalesced the same way as in reader().
+        """
+        sel = selectors.DefaultSelector()
+        sel.register(self.serial.fileno(), selectors.EVENT_READ, 'serial')
+        sel.register(self.console.fd, selectors.EVENT_READ, 'console')
+        sel.register(self.console.wake_fd, selectors.EVENT_READ, 'wake')
+        buf = bytearray()
+        deadline = 0
+        self.alive = True
+        self.console.setup()
+        try:
+            while self.alive:
+                timeout = None
+                if buf:
+                    timeout = max(0, min(self.rx_idle_gap, deadline - monotonic()))
+                events = sel.select(timeout)
+                if not events:
+                    # input went idle or held long enough
+                    self.handle_rx(buf)
+                    del buf[:]
+                for key, mask in events:
+                    if key.data == 'serial':
+                        data = self.serial.read(self.serial.in_waiting or 1)
+                        if not buf:
+                            deadline = monotonic() + self.rx_flush_time
+                        buf += data
+                        if (len(buf) >= self.rx_flush_size or b'\n' in data or
+                                monotonic() >= deadline):
+                            self.handle_rx(buf)
+                            del buf[:]
+                    elif key.data == 'wake':
+                        # quit() from another thread, the loop checks alive
+                        self.console.drain_wake()
+                    else:
+                        for c in self.console.read_keys():
+                            if not self.alive:
+                                break
+                            self.handle_key(c)
+        except serial.SerialException:
+            self.alive = False
+            raise
+        finally:
+            if buf:
+                self.handle_rx(buf)
+            sel.close()
+            self.console.cleanup()
+
     def handle_menu_key(self, c):
         """Implement a simple menu / settings"""
         if c == self.menu_character or c == self.exit_character:
             # Menu/exit character again -> send itself
-            self.serial.write(self.tx_encoder.encode(c))
+            self.write_tx(self.tx_encoder.encode(c))
             if self.echo:
                 self.console.write(c)
         elif c == '\x15':                       # CTRL+U -> upload file
@@ -588,7 +1086,7 @@ class Miniterm(object):
                                 block = f.read(1024)
                                 if not block:
                                     break
-                                self.serial.write(block)
+                                self.write_tx(block)
                                 # Wait for output buffer to drain.
                                 self.serial.flush()
                                 sys.stderr.write('.')   # Progress indicator.
@@ -691,6 +1189,171 @@ class Miniterm(object):
            filter=key_description('\x06'),
            eol=key_description('\x0c'))
 
+#------------------------------------
+#
+# Diagnostics
+#
+#------------------------------------
+
+log = logging.getLogger('wdc_uploader')
+
+
+class HexArg(object):
+    """log argument that is only turned into hex when the record is formatted"""
+
+    def __init__(self, data, limit=32):
+        self.data = data
+        self.limit = limit
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        text = binascii.hexlify(data[:self.limit], ' ').decode().upper()
+        return text + ' ...' if len(data) > self.limit else text
+
+
+class JsonFormatter(logging.Formatter):
+    """one JSON object per line: time, level, message and the extra fields"""
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+        'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname,
+                 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(verbose=0, path=None, as_json=False):
+    """\
+    Send the diagnostics to stderr, -v shows INFO and -v -v DEBUG records.
+    With path all DEBUG records go to that file instead.
+    """
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    if as_json:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(relativeCreated)9.1f %(levelname)s %(message)s'))
+    log.addHandler(handler)
+    log.propagate = False
+    if path or verbose > 1:
+        log.setLevel(logging.DEBUG)
+    elif verbose > 0:
+        log.setLevel(logging.INFO)
+    else:
+        log.setLevel(logging.WARNING)
+
+
+def log_frame(name, address, length, reply, start):
+    """\
+    Log one bootloader frame at DEBUG level with its timing, start is the
+    perf_counter() before the frame was sent. Check log.isEnabledFor()
+    before calling it in a loop.
+    """
+    seconds = perf_counter() - start
+    log.debug('%s 0x%06X %d bytes, reply %s, %.3f ms', name, address, length,
+              HexArg(reply, 8), seconds * 1000,
+              extra={'frame': name, 'address': address, 'length': length,
+                     'reply': binascii.hexlify(reply[:8]).decode(), 'seconds': seconds})
+
+#------------------------------------
+#
+# Serial Transport
+#
+#------------------------------------
+
+# size of the preallocated FdTransport read buffer
+FD_BUFFER_SIZE = 65536
+
+
+class FdTransport(object):
+    """\
+    EMCSerial transport working on the file descriptor of an open POSIX
+    pyserial port, which has already configured termios and opened it
+    non-blocking: os.write and os.readv into a preallocated buffer, with
+    select() for the port timeouts. cancel_read() wakes a waiting read
+    through a pipe of its own. Everything else, settings and modem lines,
+    is passed on to the port.
+    """
+
+    def __init__(self, serial_instance, size=FD_BUFFER_SIZE):
+        self.__dict__['_serial'] = serial_instance
+        self.__dict__['_fd'] = serial_instance.fileno()
+        self.__dict__['_view'] = memoryview(bytearray(size))
+        cancel_r, cancel_w = os.pipe()
+        os.set_blocking(cancel_r, False)
+        os.set_blocking(cancel_w, False)
+        self.__dict__['_cancel_r'] = cancel_r
+        self.__dict__['_cancel_w'] = cancel_w
+
+    @staticmethod
+    def usable(serial_instance):
+        """True for ports opened by pyserial's POSIX backend"""
+        return os.name == 'posix' and isinstance(serial_instance, serial.Serial)
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._serial, name, value)
+
+    def cancel_read(self):
+        try:
+            os.write(self._cancel_w, b'x')
+        except BlockingIOError:
+            pass
+
+    def clear_cancel_read(self):
+        """drop a cancel_read() that no read() has consumed"""
+        while True:
+            try:
+                os.read(self._cancel_r, 1000)
+            except BlockingIOError:
+                break
+
+    def close(self):
+        os.close(self._cancel_r)
+        os.close(self._cancel_w)
+        self._serial.close()
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        timeout = self._serial.write_timeout
+        while view:
+            try:
+                view = view[os.write(self._fd, view):]
+            except BlockingIOError:
+                if not select.select([], [self._fd], [], timeout)[1]:
+                    raise serial.SerialTimeoutException('Write timeout')
+        return len(data)
+
+    def read(self, size=1):
+        view = self._view if size <= len(self._view) else memoryview(bytearray(size))
+        timeout = self._serial.timeout
+        deadline = None if timeout is None else monotonic() + timeout
+        got = 0
+        while got < size:
+            wait = None if deadline is None else max(0, deadline - monotonic())
+            ready = select.select([self._fd, self._cancel_r], [], [], wait)[0]
+            if self._cancel_r in ready:
+                self.clear_cancel_read()
+                break
+            if not ready:
+                break
+            try:
+                count = os.readv(self._fd, [view[got:size]])
+            except BlockingIOError:
+                continue
+            if not count:
+                raise serial.SerialException(
+                    'device reports readiness to read but returned no data')
+            got += count
+        return bytes(view[:got])
+
 #------------------------------------
 #
 # EMC Serial Class
@@ -698,6 +1361,11 @@ class Miniterm(object):
 #------------------------------------
 
 class EMCSerial:
+    """\
+    The bootloader protocol on a transport: any object with write(data),
+    read(size) that waits up to its timeout attribute, and name. That is a
+    pyserial port or an FdTransport, possibly wrapped in a TracedSerial.
+    """
 
     def __init__(self, serial, verbose=0):
         self.serial = serial
@@ -711,14 +1379,143 @@ class EMCSerial:
             if hexify:
                 data = serial.to_bytes([int(data, 16)])
                 self.serial.write(data)
-                if self.verbose > 1:
-                    print('W|%s ' % hex(data[0]),)
             else:
                 self.serial.write(data.encode("utf-8").hex().encode())
         except Exception as e:
             print("Error writing to serial port %s: %s" %
                   (self.serial.name, str(e)))
 
+    def write_bytes(self, data):
+        """write a whole bytes object in one go"""
+        try:
+            self.serial.write(data)
+        except Exception as e:
+            print("Error writing to serial port %s: %s" %
+                  (self.serial.name, str(e)))
+
+    def read_exact(self, length):
+        """read length bytes, returns less if the port timeout expires"""
+        data = bytearray()
+        try:
+            while len(data) < length:
+                chunk = self.serial.read(length - len(data))
+                if not chunk:
+                    break
+                data.extend(chunk)
+        except Exception as e:
+            print("Error reading from serial port %s, %s" % (
+                self.serial.name, str(e)))
+        return bytes(data)
+
+    def write_mem(self, address, data):
+        """send data in one EMC_WRITE_MEM frame, returns the status byte"""
+        start = perf_counter()
+        self.write_bin_command(EMC_WRITE_MEM_COMMAND)
+        self.write_bytes(address.to_bytes(3, 'little') +
+                         len(data).to_bytes(3, 'little') + data)
+        status = self.read_exact(1)
+        if log.isEnabledFor(logging.DEBUG):
+            log_frame('WRITE_MEM', address, len(data), status, start)
+        return status
+
+    def read_mem(self, address, length):
+        """read length bytes of memory with EMC_READ_MEM"""
+        start = perf_counter()
+        self.write_bin_command(EMC_READ_MEM_COMMAND)
+        self.write_bytes(address.to_bytes(3, 'little') + length.to_bytes(3, 'little'))
+        data = self.read_exact(length)
+        if log.isEnabledFor(logging.DEBUG):
+            log_frame('READ_MEM', address, length, data, start)
+        return data
+
+    def read_mem_chunks(self, address, length, size=4096):
+        """\
+        generate length bytes of memory from address as they arrive, with one
+        EMC_READ_MEM per 64K bank (the bootloader only increments the 16 bit
+        offset), until the port timeout
+        """
+        while length > 0:
+            part = min(length, 0x10000 - (address & 0xFFFF))
+            self.write_bin_command(EMC_READ_MEM_COMMAND)
+            self.write_bytes(address.to_bytes(3, 'little') + part.to_bytes(3, 'little'))
+            received = 0
+            for chunk in self.read_chunks(part, size):
+                received += len(chunk)
+                yield chunk
+            if received < part:
+                return
+            address += part
+            length -= part
+
+    def read_reply(self, length=0, terminator=None, idle=0.05):
+        """\
+        Read a reply of unknown size: wait up to the port timeout for the
+        first byte, then stop after length bytes (if not 0), after the
+        terminator or when nothing arrives for idle seconds.
+        """
+        data = bytearray()
+        timeout = self.serial.timeout
+        try:
+            chunk = self.serial.read(1)
+            self.serial.timeout = idle
+            while chunk:
+                data.extend(chunk)
+                if length and len(data) >= length:
+                    break
+                if terminator and terminator in data[-len(chunk) - len(terminator):]:
+                    break
+                size = max(self.serial.in_waiting, 1)
+                chunk = self.serial.read(min(size, length - len(data)) if length else size)
+        except Exception as e:
+            print("Error reading from serial port %s, %s" % (
+                self.serial.name, str(e)))
+        finally:
+            self.serial.timeout = timeout
+        return bytes(data)
+
+    def read_flash_chunks(self, offset, length, size=4096):
+        """\
+        send one EMC_READ_FLASH for length bytes from offset (0 is 0x8000) and
+        generate the reply as it arrives, until the port timeout
+        """
+        self.write_bin_command(EMC_READ_FLASH_COMMAND)
+        self.write_bytes(offset.to_bytes(3, 'little') + length.to_bytes(3, 'little'))
+        return self.read_chunks(length, size)
+
+    def read_flash(self, offset, length):
+        """read length bytes of flash from offset (0 is 0x8000) with EMC_READ_FLASH"""
+        start = perf_counter()
+        self.write_bin_command(EMC_READ_FLASH_COMMAND)
+        self.write_bytes(offset.to_bytes(3, 'little') + length.to_bytes(3, 'little'))
+        data = self.read_exact(length)
+        if log.isEnabledFor(logging.DEBUG):
+            log_frame('READ_FLASH', offset, length, data, start)
+        return data
+
+    def write_flash(self, address, data, timeout=None, progress=None):
+        """\
+        program data at address (0x8000-0xFFFF) in one EMC_WRITE_FLASH frame,
+        returns the status byte or b'' if none arrived within timeout seconds.
+        progress is called with the bytes sent so far while data goes out.
+        """
+        start = perf_counter()
+        self.write_bin_command(EMC_WRITE_FLASH_COMMAND)
+        self.write_bytes(address.to_bytes(3, 'little') + len(data).to_bytes(3, 'little'))
+        for pos in range(0, len(data), FLASH_PROGRESS_STEP):
+            self.write_bytes(data[pos:pos + FLASH_PROGRESS_STEP])
+            if progress is not None:
+                progress(min(pos + FLASH_PROGRESS_STEP, len(data)))
+        saved = self.serial.timeout
+        if timeout is not None:
+            self.serial.timeout = timeout
+        try:
+            status = self.read_exact(1)
+        finally:
+            self.serial.timeout = saved
+        if log.isEnabledFor(logging.DEBUG):
+            log_frame('WRITE_FLASH', address, len(data), status, start)
+        return status
+
     def read_serial_raw(self):
         info = []
         try:
@@ -726,8 +1523,7 @@ class EMCSerial:
             while i:
                 info.append(ord(i))
                 i = self.serial.read()
-            if self.verbose > 1:
-                print('R|%s ' % info,)
+            log.debug('rx %d bytes: %s', len(info), HexArg(bytes(info)))
         except Exception as e:
             print("Error reading from serial port %s, %s" % (
                 self.serial.name, str(e)))
@@ -737,15 +1533,10 @@ class EMCSerial:
         info = ""
         try:
             i = self.serial.read()
-            if self.verbose > 1:
-                print('r|%s ' % hex(ord(i)),)
             while i:
                 info += chr(ord(i))
                 i = self.serial.read()
-                if self.verbose > 1:
-                    print('r|%s ' % hex(ord(i)),)
-            if self.verbose > 1:
-                print('R|%s ' % info,)
+            log.debug('rx %d bytes: %s', len(info), HexArg(info))
         except Exception as e:
             print("Error reading from serial port %s, %s" % (
                 self.serial.name, str(e)))
@@ -756,8 +1547,6 @@ class EMCSerial:
         self.write_serial('AA')
         try:
             i = self.serial.read()
-            if self.verbose > 1:
-                print('%s ' % i,)
             if hex(ord(i)) != '0xcc':
                 print("Error initializing write response. Expected 0xcc but got %s" % hex(
                     ord(i)))
@@ -771,6 +1560,8 @@ class EMCSerial:
         self.write_serial(cmd)
 
     def write_bin_block(self, cmd, address, length=None, data=None):
+        log.debug('command %s, address %s, length %s, %d data bytes', cmd, ''.join(address),
+                  length and ''.join(length), len(data or ()))
         self.write_bin_command(cmd)
         for d in address:
             self.write_serial(d)
@@ -792,15 +1583,65 @@ class EMCSerial:
             self.write_serial(d)
 
     def separate_hex(self, data):
-        #bytes = binascii.hexlify(data.encode())
-        chars = list(data)
-        byte_array = [hex(ord(chars[i]))[2:].zfill(2)
-                      for i in range(0, len(chars))]
-        # byte_array = [bytes[i:i+2].decode('utf-8')
-        #               for i in range(0, len(bytes), 2)]
-        inf = ' '.join(byte_array)
-        inf = inf.upper()
-        return inf
+        """'AB CD ...' for a string of byte values as returned by read_serial"""
+        return binascii.hexlify(data.encode('latin-1'), ' ').decode().upper()
+
+    def read_chunks(self, length, size=4096):
+        """generate the next length bytes as they arrive, until the port timeout"""
+        try:
+            while length > 0:
+                chunk = self.serial.read(min(length, size))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        except Exception as e:
+            print("Error reading from serial port %s, %s" % (
+                self.serial.name, str(e)))
+
+# printable ASCII for the hexdump ASCII column, '.' for everything else
+HEXDUMP_ASCII = bytes(c if 0x20 <= c < 0x7F else 0x2E for c in range(256))
+
+
+def hexdump(chunks, address=0, width=16, ascii=False):
+    """\
+    Generate the lines of a hex dump ('ADDR:\tXX XX ...', optionally with an
+    ASCII column) of a bytes-like object or an iterable of them. Only the
+    current chunk is held in memory.
+    """
+    if isinstance(chunks, (bytes, bytearray, memoryview)):
+        chunks = [chunks]
+    step = width * 3
+    rest = b''
+    for chunk in chunks:
+        if rest:
+            chunk = rest + bytes(chunk)
+        end = len(chunk) - len(chunk) % width
+        rest = bytes(chunk[end:])
+        if not end:
+            continue
+        data = memoryview(chunk)[:end]
+        text = binascii.hexlify(data, ' ').decode().upper()
+        chars = data.tobytes().translate(HEXDUMP_ASCII).decode() if ascii else None
+        for i in range(0, end // width):
+            line = '%X:\t%s' % (address, text[i * step:i * step + step - 1])
+            if ascii:
+                line += '  |%s|' % chars[i * width:i * width + width]
+            yield line
+            address += width
+    if rest:
+        text = binascii.hexlify(rest, ' ').decode().upper()
+        if ascii:
+            yield '%X:\t%-*s  |%s|' % (address, step - 1, text,
+                                       rest.translate(HEXDUMP_ASCII).decode())
+        else:
+            yield '%X:\t%s' % (address, text)
+
+
+def block_chunks(block, size=4096):
+    """generate the data of an InfileDataBlock as bytes, size bytes at a time"""
+    for i in range(0, len(block.data), size):
+        yield binascii.unhexlify(''.join(block.data[i:i + size]))
 
 def le2num(indata):
     if type(indata) == str:
@@ -828,6 +1669,59 @@ def num2be(num, bytes):
 
 
 
+def parse_address(text):
+    """\
+    Parse a 24 bit address. Accepted forms: hexadecimal digits with an
+    optional 0x or $ prefix (012000, 0x012000, $2000) or bank:offset
+    (01:2000, 0x01:0x2000).
+    """
+    def hexnum(s):
+        s = s.strip()
+        if s.lower().startswith('0x'):
+            s = s[2:]
+        elif s.startswith('$'):
+            s = s[1:]
+        return int(s, 16)
+
+    bank, sep, offset = text.partition(':')
+    try:
+        if sep:
+            bank = hexnum(bank)
+            offset = hexnum(offset)
+            if bank > 0xFF or offset > 0xFFFF:
+                raise ValueError
+            address = (bank << 16) | offset
+        else:
+            address = hexnum(text)
+    except ValueError:
+        raise ValueError('invalid address {!r}, use e.g. 012000, 0x012000 or 01:2000'.format(text))
+    if not 0 <= address <= 0xFFFFFF:
+        raise ValueError('address {!r} is outside of the 24 bit address space'.format(text))
+    return address
+
+
+def split_at_banks(blocks):
+    """\
+    Split blocks so that none crosses a 64K bank boundary, the bootloader
+    only increments the 16 bit offset of the address while writing.
+    """
+    result = []
+    for block in blocks:
+        while (block.address & 0xFFFF) + block.length > 0x10000:
+            head = InfileDataBlock()
+            head.address = block.address
+            head.length = 0x10000 - (block.address & 0xFFFF)
+            head.data = block.data[:head.length]
+            result.append(head)
+            rest = InfileDataBlock()
+            rest.address = block.address + head.length
+            rest.length = block.length - head.length
+            rest.data = block.data[head.length:]
+            block = rest
+        result.append(block)
+    return result
+
+
 class InfileDataBlock:
     address = None
     data = []
@@ -836,9 +1730,21 @@ class InfileData:
     execAddress = None;
     blocks = []
 
-def parse_infile(content):
+    def __init__(self):
+        self.blocks = []
+
+def data_block(address, data):
+    """an InfileDataBlock holding the bytes data at address"""
+    block = InfileDataBlock()
+    block.address = address
+    block.length = len(data)
+    h = data.hex()
+    block.data = [h[i:i + 2] for i in range(0, len(h), 2)]
+    return block
+
+def parse_infile(content, filename, address=None):
         first_char = content[0]
-        if args.FILENAME.lower().endswith('.bin') or args.FILENAME.lower().endswith('.out'):
+        if filename.lower().endswith('.bin') or filename.lower().endswith('.out'):
             # assume binary file
             data = list(content)
             # intel hex file(?)
@@ -846,8 +1752,8 @@ def parse_infile(content):
             ifdata = InfileData()
 
             addr = 0
-            if args.address:
-                addr = le2num(args.address);
+            if address:
+                addr = address
 
             #while data[0] == 0:
             #    addr = addr + 1
@@ -856,17 +1762,15 @@ def parse_infile(content):
             ifdata.execAddress = addr
             print(addr)
 
-            while len(data):
+            # one block, the frame size is chosen when uploading
+            if len(data):
                 block = InfileDataBlock()
-                outData = data[:1023]
-                data = data[1023:]
-
-                block.data = [hex(c)[2:].rjust(2,'0') for c in outData]
+                block.data = [hex(c)[2:].rjust(2,'0') for c in data]
                 block.address = addr
-                block.length = len(outData)
-                addr = addr + block.length
+                block.length = len(data)
                 ifdata.blocks.append(block)
 
+            ifdata.blocks = split_at_banks(ifdata.blocks)
             return ifdata
         elif first_char == 0x5a:
             bytes = binascii.hexlify(content)
@@ -893,6 +1797,9 @@ def parse_infile(content):
                 block.data = byte_array[:length]
                 byte_array = byte_array[length:]
                 if length == 0:
+                    # the terminator holds the start address
+                    if block.address:
+                        ifdata.execAddress = block.address
                     break
                 i += 1
 
@@ -903,15 +1810,10 @@ def parse_infile(content):
                     leng.upper(), int("0x"+leng, 16), addr.upper()))
                 if args.verbose > 0:
                     print("Data => ")
-                    s = ' '.join(block.data)
-                    s = s.upper()
-                    address = block.address
-
-                    for i in range(0, len(s), 48):
-                        print("%s:\t%s" %
-                              (hex(address)[2:].upper(), s[i:i+48]))
-                        address += 16
+                    for line in hexdump(block_chunks(block), block.address):
+                        print(line)
                     print("\n")
+            ifdata.blocks = split_at_banks(ifdata.blocks)
             return ifdata
 
         if first_char == 0x3a:
@@ -931,16 +1833,19 @@ def parse_infile(content):
             
             lines = [line.split(':')[1] for line in lines]
             ifdata = InfileData()
+            # set by extended segment (02) and extended linear (04) address records
+            base = 0
+            start_address = None
             for line in lines:
                 bytecount = int(line[0:2], 16)
-                address = int(line[2:6], 16)
+                address = base + int(line[2:6], 16)
                 type = int(line[6:8], 16)
                 data = []
                 if bytecount > 0:
                     data = line[8:(8+bytecount*2)]
                 checksum = int(line[(8+bytecount*2):(8+bytecount*2+2)], 16)
                 testsum=sum([int(line[i:i+2], 16) for i in range(0, (8+bytecount*2), 2)])
-                calcchecksum = ((testsum&0xff) - 1)^0xff;
+                calcchecksum = -testsum & 0xff
                 if checksum != calcchecksum:
                     print("Intel hex file checksum missmatch")
                     sys.exit(-1)
@@ -955,6 +1860,14 @@ def parse_infile(content):
                     ifdata.blocks.append(block)
                 elif type == 1:
                     break;
+                elif type == 2:
+                    base = int(data, 16) << 4
+                elif type == 3:
+                    start_address = (int(data[:4], 16) << 4) + int(data[4:], 16)
+                elif type == 4:
+                    base = int(data, 16) << 16
+                elif type == 5:
+                    start_address = int(data, 16)
                 else:
                     print("Intel hex file. Unhandled type: %d" % type)
                     sys.exit(-1)
@@ -968,45 +1881,2335 @@ def parse_infile(content):
                 me = ifdata.blocks[i]
                 prev = ifdata.blocks[i-1]
                 if (prev.address + prev.length) == me.address:
-                    if (args.verbose > 1):
-                        print ("Merge %d and %d" %(i, i-1))
+                    log.debug("Merge %d and %d", i, i-1)
                     prev.length = prev.length + me.length
                     prev.data.extend(me.data)
                     ifdata.blocks.pop(i)
 
             if (args.verbose > 0):
                 print("Compressed %d blocks down to %d"%(startblocks, len(ifdata.blocks)))
+            if start_address is not None:
+                ifdata.execAddress = start_address
+            ifdata.blocks = split_at_banks(ifdata.blocks)
+            return ifdata
+
+        if first_char == 0x53:
+            # S-record file, records that follow each other are joined
+            ifdata = InfileData()
+            try:
+                for address, data in read_image(io.BytesIO(content), 'srec'):
+                    if data is None:
+                        # S7/S8/S9, a zero address means none was given
+                        if address:
+                            ifdata.execAddress = address
+                        continue
+                    prev = ifdata.blocks[-1] if ifdata.blocks else None
+                    if prev is not None and prev.address + prev.length == address:
+                        prev.data.extend(data_block(address, data).data)
+                        prev.length += len(data)
+                    else:
+                        ifdata.blocks.append(data_block(address, data))
+            except ValueError as e:
+                print("Error: %s: %s" % (filename, e))
+                sys.exit(1)
+            if ifdata.execAddress is None and ifdata.blocks:
+                ifdata.execAddress = ifdata.blocks[0].address
+            ifdata.blocks = split_at_banks(ifdata.blocks)
             return ifdata
 
         print("Error: File is not a Z-bin file")
         sys.exit(1)
 
         return None
-####################################
+#------------------------------------
 #
-# Main Program Start
+# Write Framing
 #
-####################################
+#------------------------------------
 
-note = """Example: script.py -d /dev/ttyUSB0 -x 1000 filename.bin\n
-		"""
+# frame sizes tried by --block-size auto
+FRAME_CANDIDATES = [64, 256, 1024, 4096, 16384]
 
-if __name__ == '__main__':
-    import argparse
-    from argparse import RawTextHelpFormatter
 
-    parser = argparse.ArgumentParser(
-        description='Upload file to board or execute some other command', epilog=note, formatter_class=RawTextHelpFormatter)
+class FramePolicy(object):
+    """\
+    How the blocks of an image are cut into EMC_WRITE_MEM frames:
+      N       frames of N bytes, the last one of a block may be shorter
+      max:N   as few frames per block as possible, of equal size <= N
+      max     one frame per block
+      auto    measure the throughput of the candidate sizes on the first
+              part of the upload, then use the fastest for the rest
+    Blocks never cross a bank, so neither does a frame.
+    """
 
-    parser.add_argument(
-        'FILENAME',
-        nargs='?',
-        help='set the file name/path for the .bin file',
-        default=None)
+    def __init__(self, spec='max'):
+        self.mode = 'max'
+        self.size = None
+        if spec == 'auto':
+            self.mode = 'auto'
+        elif spec.startswith('max'):
+            _, _, size = spec.partition(':')
+            self.size = int(size, 0) if size else None
+        else:
+            self.mode = 'fixed'
+            self.size = int(spec, 0)
+        if self.size is not None and not 0 < self.size <= 0x10000:
+            raise ValueError('block size must be between 1 and 65536')
+
+    def __repr__(self):
+        if self.mode == 'fixed':
+            return str(self.size)
+        if self.mode == 'max' and self.size:
+            return 'max:%d' % self.size
+        return self.mode
+
+    def sizes(self, length):
+        """frame sizes for a block of length bytes (not used for auto)"""
+        if self.size is None or length <= self.size:
+            return [length]
+        if self.mode == 'fixed':
+            return [self.size] * (length // self.size) + (
+                [length % self.size] if length % self.size else [])
+        count = -(-length // self.size)
+        size = -(-length // count)
+        return [size] * (length // size) + ([length % size] if length % size else [])
+
+    def frames(self, blocks):
+        """\
+        Generate (address, data) frames. The caller must send each frame
+        and wait for its ack before asking for the next one, auto mode
+        times the gap between frames.
+        """
+        if self.mode == 'auto':
+            for frame in self._tune(blocks):
+                yield frame
+            return
+        for block in blocks:
+            data = binascii.unhexlify(''.join(block.data))
+            pos = 0
+            for size in self.sizes(len(data)):
+                yield block.address + pos, data[pos:pos + size]
+                pos += size
+
+    def _tune(self, blocks):
+        """\
+        Send the first bytes of the image with every candidate size in
+        turn, at least 4K (or one frame) per candidate, and keep the size
+        with the best throughput for the rest. Nothing is sent twice.
+        """
+        largest = max([block.length for block in blocks] or [0])
+        candidates = [s for s in FRAME_CANDIDATES if s <= largest]
+        if not candidates:
+            # every block fits in a frame smaller than any candidate
+            self.mode = 'max'
+            for frame in self.frames(blocks):
+                yield frame
+            return
+        results = []
+        size = None
+        sent = elapsed = 0
+        for block in blocks:
+            data = binascii.unhexlify(''.join(block.data))
+            pos = 0
+            while pos < len(data):
+                if size is None or (sent >= max(size, 4096) and self.mode == 'auto'):
+                    if size is not None:
+                        results.append((size, sent / elapsed if elapsed else 0))
+                    if candidates:
+                        size = candidates.pop(0)
+                        sent = elapsed = 0
+                    else:
+                        self._select(results)
+                        size = self.size
+                chunk = data[pos:pos + size]
+                start = perf_counter()
+                yield block.address + pos, chunk
+                elapsed += perf_counter() - start
+                sent += len(chunk)
+                pos += len(chunk)
+        if self.mode == 'auto':
+            if size is not None and sent:
+                results.append((size, sent / elapsed if elapsed else 0))
+            self._select(results)
+
+    def _select(self, results):
+        """pick the smallest size within 3% of the best throughput"""
+        self.mode = 'fixed'
+        if not results:
+            self.mode = 'max'
+            return
+        best = max(rate for size, rate in results)
+        self.size = min(size for size, rate in results if rate >= 0.97 * best)
+        print("Block size auto-tune: %s -> %d bytes" % (', '.join(
+            '%d: %.0f B/s' % r for r in results), self.size))
+
+def parse_sparse(text):
+    """parse FILL[:MIN] for --sparse, returns (fill byte, minimum run length)"""
+    fill, _, minimum = text.partition(':')
+    fill = int(fill, 16)
+    minimum = int(minimum, 0) if minimum else 64
+    if not 0 <= fill <= 0xFF or minimum < 1:
+        raise ValueError(text)
+    return fill, minimum
+
+
+def sparse_blocks(blocks, fill, minimum=64):
+    """\
+    Drop runs of at least minimum fill bytes from the blocks, splitting
+    blocks around them. Returns (blocks, bytes skipped, number of runs).
+    """
+    pattern = re.compile(re.escape(bytes([fill])) + b'{%d,}' % minimum)
+    result = []
+    skipped = runs = 0
+    for block in blocks:
+        data = binascii.unhexlify(''.join(block.data))
+        pos = 0
+        for m in pattern.finditer(data):
+            if m.start() > pos:
+                result.append((block.address + pos, data[pos:m.start()]))
+            skipped += m.end() - m.start()
+            runs += 1
+            pos = m.end()
+        if pos < len(data):
+            result.append((block.address + pos, data[pos:]))
+    return [data_block(address, data) for address, data in result], skipped, runs
 
-    parser.add_argument(
-        '-b', '--baudrate',
-        type=int,
+#------------------------------------
+#
+# Linking Several Files
+#
+#------------------------------------
+
+def split_file_spec(spec):
+    """split FILENAME[@ADDRESS] into (filename, address or None)"""
+    filename, sep, address = spec.rpartition('@')
+    if sep and filename:
+        try:
+            return filename, parse_address(address)
+        except ValueError:
+            pass
+    return spec, None
+
+
+def is_binary(filename):
+    """True for files without addresses of their own (.bin, .out)"""
+    return filename.lower().endswith(('.bin', '.out'))
+
+
+def load_infile(filename, address=None, cache=None):
+    """\
+    Read and parse one file. Binary files are loaded at address, other
+    formats are moved so their lowest address becomes address.
+    """
+    binary = is_binary(filename)
+
+    def parse(content):
+        return parse_infile(content, filename, address if binary else None)
+
+    if cache is not None:
+        # everything besides the content that parse_infile looks at
+        ifdata = cache.get(filename, parse, repr((binary, address if binary else None)))
+    else:
+        with open(filename, 'rb') as f:
+            ifdata = parse(f.read())
+
+    if not binary and address is not None and ifdata.blocks:
+        offset = address - min(block.address for block in ifdata.blocks)
+        for block in ifdata.blocks:
+            block.address += offset
+        if ifdata.execAddress is not None:
+            ifdata.execAddress += offset
+        ifdata.blocks = split_at_banks(ifdata.blocks)
+    return ifdata
+
+
+def link_images(images, verbose=0):
+    """\
+    Merge the blocks of several parsed files, given as (name, InfileData),
+    into one image. Blocks are kept in an interval index sorted by start
+    address. Overlapping blocks are reported and end the program, adjacent
+    ones are joined so the upload needs as few EMC_WRITE_MEM frames as
+    possible. The exec address is the one of the first file.
+    """
+    starts = []
+    entries = []        # (start, end, name, block), end exclusive
+    overlaps = []
+    for name, ifdata in images:
+        for block in ifdata.blocks:
+            if not block.length:
+                continue
+            start = block.address
+            end = start + block.length
+            i = bisect.bisect_right(starts, start)
+            if i > 0 and entries[i - 1][1] > start:
+                overlaps.append((entries[i - 1], (start, end, name)))
+            j = i
+            while j < len(entries) and entries[j][0] < end:
+                overlaps.append((entries[j], (start, end, name)))
+                j += 1
+            starts.insert(i, start)
+            entries.insert(i, (start, end, name, block))
+
+    if overlaps:
+        for a, b in overlaps:
+            print("Error: %s 0x%06X-0x%06X overlaps %s 0x%06X-0x%06X" % (
+                b[2], b[0], b[1] - 1, a[2], a[0], a[1] - 1))
+        sys.exit(1)
+
+    linked = InfileData()
+    linked.execAddress = images[0][1].execAddress if images else None
+    for start, end, name, block in entries:
+        prev = linked.blocks[-1] if linked.blocks else None
+        if prev is not None and prev.address + prev.length == start:
+            prev.data = prev.data + block.data
+            prev.length += block.length
+        else:
+            merged = InfileDataBlock()
+            merged.address = start
+            merged.length = block.length
+            merged.data = list(block.data)
+            linked.blocks.append(merged)
+    linked.blocks = split_at_banks(linked.blocks)
+
+    if verbose > 0 or len(images) > 1:
+        print("Linked %d file(s), %d blocks into %d ranges:" % (
+            len(images), len(entries), len(linked.blocks)))
+        for block in linked.blocks:
+            names = sorted(set(e[2] for e in entries
+                               if block.address <= e[0] < block.address + block.length))
+            print("    0x%06X-0x%06X  %s" % (
+                block.address, block.address + block.length - 1, ', '.join(names)))
+    return linked
+
+#------------------------------------
+#
+# Format Conversion
+#
+#------------------------------------
+
+# output formats of -m convert and the file extensions that select them,
+# anything else is written as a Zardoz Z image
+CONVERT_FORMATS = {
+    'zbin': (),
+    'hex': ('.hex', '.ihx'),
+    'bin': ('.bin', '.out'),
+    'srec': ('.s19', '.s28', '.s37', '.srec', '.mot'),
+}
+# bytes read from an input file at a time
+CONVERT_CHUNK = 4096
+# data bytes per Intel HEX or S-record line
+RECORD_SIZE = 32
+
+
+def input_format(filename, first):
+    """format of an input file from its name and first byte, like parse_infile"""
+    if filename.lower().endswith(('.bin', '.out')):
+        return 'bin'
+    return {b'Z': 'zbin', b':': 'hex', b'S': 'srec'}.get(first)
+
+
+def output_format(filename):
+    """format selected by the extension of an output file"""
+    for name, extensions in CONVERT_FORMATS.items():
+        if filename.lower().endswith(extensions):
+            return name
+    return 'zbin'
+
+
+def read_image(f, kind, address=0):
+    """\
+    Generate the (address, data) records of an image file opened in binary
+    mode, reading a line or a few KB at a time. data is None for the start
+    address. Raises ValueError on malformed input.
+    """
+    if kind == 'bin':
+        pos = address
+        data = f.read(CONVERT_CHUNK)
+        while data:
+            yield pos, data
+            pos += len(data)
+            data = f.read(CONVERT_CHUNK)
+        yield address, None
+    elif kind == 'zbin':
+        f.read(1)
+        while True:
+            header = f.read(6)
+            if len(header) < 6:
+                raise ValueError('truncated Z image')
+            address = int.from_bytes(header[:3], 'little')
+            length = int.from_bytes(header[3:], 'little')
+            if not length:
+                # the zero length terminator holds the start address
+                if address:
+                    yield address, None
+                break
+            while length:
+                data = f.read(min(length, CONVERT_CHUNK))
+                if not data:
+                    raise ValueError('truncated Z image')
+                yield address, data
+                address += len(data)
+                length -= len(data)
+    elif kind == 'hex':
+        base = 0
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = bytes.fromhex(line[1:].decode('ascii'))
+            except (ValueError, UnicodeDecodeError):
+                record = b''
+            if line[:1] != b':' or len(record) < 5 or len(record) != record[0] + 5 \
+                    or sum(record) & 0xFF:
+                raise ValueError('line %d is not a valid Intel HEX record' % number)
+            rtype, data = record[3], record[4:-1]
+            if rtype == 0:
+                yield base + int.from_bytes(record[1:3], 'big'), data
+            elif rtype == 1:
+                break
+            elif rtype == 2:
+                base = int.from_bytes(data, 'big') << 4
+            elif rtype == 3:
+                yield (int.from_bytes(data[:2], 'big') << 4) + int.from_bytes(data[2:], 'big'), None
+            elif rtype == 4:
+                base = int.from_bytes(data, 'big') << 16
+            elif rtype == 5:
+                yield int.from_bytes(data, 'big'), None
+            else:
+                raise ValueError('line %d: unhandled record type %02X' % (number, rtype))
+    elif kind == 'srec':
+        sizes = {b'1': 2, b'2': 3, b'3': 4, b'7': 4, b'8': 3, b'9': 2}
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = bytes.fromhex(line[2:].decode('ascii'))
+            except (ValueError, UnicodeDecodeError):
+                record = b''
+            if line[:1] != b'S' or len(record) < 3 or len(record) != record[0] + 1 \
+                    or sum(record) & 0xFF != 0xFF:
+                raise ValueError('line %d is not a valid S-record' % number)
+            rtype = line[1:2]
+            size = sizes.get(rtype)
+            if size is None:
+                # S0 header, S5/S6 record count
+                continue
+            address = int.from_bytes(record[1:1 + size], 'big')
+            if rtype in (b'1', b'2', b'3'):
+                yield address, record[1 + size:-1]
+            else:
+                yield address, None
+                break
+    else:
+        raise ValueError('unknown input format')
+
+
+class ImageWriter(object):
+    """\
+    Base of the -m convert writers. Contiguous data is joined into blocks
+    of at most block_size bytes that do not cross a bank and passed on to
+    write_block(), the start address (or else the first data address) to
+    finish().
+    """
+
+    block_size = RECORD_SIZE
+
+    def __init__(self, f):
+        self.f = f
+        self.start = None
+        self.first = None
+        self.blocks = 0
+        self.length = 0
+        self._address = None
+        self._buffer = bytearray()
+
+    def add(self, address, data):
+        """add a record generated by read_image()"""
+        if data is None:
+            self.start = address
+            return
+        if self.first is None:
+            self.first = address
+        if self._address is None or address != self._address + len(self._buffer):
+            self._flush()
+            self._address = address
+        while data:
+            end = self._address + len(self._buffer)
+            room = min(self.block_size - len(self._buffer), 0x10000 - (end & 0xFFFF))
+            self._buffer += data[:room]
+            data = data[room:]
+            if data:
+                self._flush()
+                self._address = end + room
+
+    def _flush(self):
+        if self._buffer:
+            self.write_block(self._address, bytes(self._buffer))
+            self.blocks += 1
+            self.length += len(self._buffer)
+            del self._buffer[:]
+
+    def close(self):
+        """write out the rest, the file itself stays open"""
+        self._flush()
+        self.finish(self.start if self.start is not None else self.first)
+
+    def write_block(self, address, data):
+        raise NotImplementedError
+
+    def finish(self, start):
+        pass
+
+
+class ZardozWriter(ImageWriter):
+    """Zardoz Z image: blocks of 3 byte address, 3 byte length and data"""
+
+    block_size = 0x10000
+
+    def __init__(self, f):
+        super(ZardozWriter, self).__init__(f)
+        f.write(b'Z')
+
+    def write_block(self, address, data):
+        self.f.write(address.to_bytes(3, 'little') + len(data).to_bytes(3, 'little'))
+        self.f.write(data)
+
+    def finish(self, start):
+        self.f.write((start or 0).to_bytes(3, 'little') + bytes(3))
+
+
+class IntelHexWriter(ImageWriter):
+    """Intel HEX with extended linear address and start linear address records"""
+
+    def __init__(self, f):
+        super(IntelHexWriter, self).__init__(f)
+        self._upper = 0
+
+    def _record(self, rtype, offset, data=b''):
+        body = bytes([len(data), offset >> 8, offset & 0xFF, rtype]) + data
+        self.f.write(b':%s\n' % binascii.hexlify(body + bytes([-sum(body) & 0xFF])).upper())
+
+    def write_block(self, address, data):
+        if address >> 16 != self._upper:
+            self._upper = address >> 16
+            self._record(4, 0, self._upper.to_bytes(2, 'big'))
+        self._record(0, address & 0xFFFF, data)
+
+    def finish(self, start):
+        if start is not None:
+            self._record(5, 0, start.to_bytes(4, 'big'))
+        self._record(1, 0)
+
+
+class SRecordWriter(ImageWriter):
+    """Motorola S-records, S1 or S2 data records depending on the address"""
+
+    def __init__(self, f):
+        super(SRecordWriter, self).__init__(f)
+        self._record(b'0', 0, 2)
+
+    def _record(self, rtype, address, size, data=b''):
+        body = bytes([size + len(data) + 1]) + address.to_bytes(size, 'big') + data
+        self.f.write(b'S%s%s\n' % (rtype, binascii.hexlify(
+            body + bytes([~sum(body) & 0xFF])).upper()))
+
+    def write_block(self, address, data):
+        if address + len(data) <= 0x10000:
+            self._record(b'1', address, 2, data)
+        else:
+            self._record(b'2', address, 3, data)
+
+    def finish(self, start):
+        if self.blocks <= 0xFFFF:
+            self._record(b'5', self.blocks, 2)
+        else:
+            self._record(b'6', self.blocks, 3)
+        start = start or 0
+        if start <= 0xFFFF:
+            self._record(b'9', start, 2)
+        else:
+            self._record(b'8', start, 3)
+
+
+class BinaryWriter(ImageWriter):
+    """\
+    Raw binary starting at the first data address, gaps are filled with
+    fill. Data before the first address is an error.
+    """
+
+    block_size = CONVERT_CHUNK
+
+    def __init__(self, f, fill=0xFF):
+        super(BinaryWriter, self).__init__(f)
+        self.fill = fill
+        self._size = 0
+
+    def write_block(self, address, data):
+        offset = address - self.first
+        if offset < 0:
+            raise ValueError('data at 0x%06X is before the first address 0x%06X of '
+                             'the binary output' % (address, self.first))
+        if offset > self._size:
+            self.f.seek(self._size)
+            for pos in range(self._size, offset, CONVERT_CHUNK):
+                self.f.write(bytes([self.fill]) * min(CONVERT_CHUNK, offset - pos))
+        self.f.seek(offset)
+        self.f.write(data)
+        self._size = max(self._size, offset + len(data))
+
+
+def convert_image(infile, outfile, kind=None, address=0, fill=0xFF):
+    """\
+    Convert infile to outfile in format kind (default from the extension),
+    binary input is loaded at address. Returns (input format, output
+    format, writer), raises ValueError on bad input.
+    """
+    if kind is None:
+        kind = output_format(outfile)
+    with open(infile, 'rb') as f:
+        source = input_format(infile, f.read(1))
+        if source is None:
+            raise ValueError('%s: unknown file format' % infile)
+        f.seek(0)
+        with open(outfile, 'wb') as out:
+            if kind == 'bin':
+                writer = BinaryWriter(out, fill)
+            else:
+                writer = {'zbin': ZardozWriter, 'hex': IntelHexWriter,
+                          'srec': SRecordWriter}[kind](out)
+            for record in read_image(f, source, address):
+                writer.add(*record)
+            writer.close()
+    return source, kind, writer
+
+#------------------------------------
+#
+# Parsed Image Cache
+#
+#------------------------------------
+
+# image files: IMAGE_MAGIC, IMAGE_HEADER (exec address or -1, block count),
+# then per block IMAGE_SEGMENT (address, length) followed by the data
+IMAGE_MAGIC = b'WDCIMG1\n'
+IMAGE_HEADER = struct.Struct('<iI')
+IMAGE_SEGMENT = struct.Struct('<II')
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'wdc_uploader_term')
+
+
+class ImageCache(object):
+    """\
+    On-disk cache of parsed files, keyed by a hash of the file content and
+    the parse parameters. A reference per file path remembers mtime and
+    size, so an unchanged file is not even read again. Least recently used
+    images are removed when the cache grows over max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=256 << 20, verbose=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _write(self, name, data):
+        # write to a temporary file first, other runs may read concurrently
+        tmp = self._path('%s.%d.tmp' % (name, os.getpid()))
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+
+    def get(self, filename, parse, params=''):
+        """\
+        Return the parsed image of filename, calling parse(content) only
+        if it is not cached. params must describe everything besides the
+        content that changes the result of parse.
+        """
+        st = os.stat(filename)
+        ref_name = hashlib.sha256(
+            (os.path.abspath(filename) + '\0' + params).encode('utf-8')).hexdigest() + '.ref'
+        try:
+            with open(self._path(ref_name)) as f:
+                mtime, size, key = f.read().split()
+            if int(mtime) == st.st_mtime_ns and int(size) == st.st_size:
+                ifdata = self.load(key)
+                if ifdata is not None:
+                    return ifdata
+        except (OSError, ValueError):
+            pass
+
+        with open(filename, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha256(params.encode('utf-8') + b'\0' + content).hexdigest()
+        ifdata = self.load(key)
+        if ifdata is None:
+            ifdata = parse(content)
+            self.store(key, ifdata)
+        self._write(ref_name, ('%d %d %s\n' % (st.st_mtime_ns, st.st_size, key)).encode())
+        return ifdata
+
+    def load(self, key):
+        """return the cached image for key or None"""
+        name = self._path(key + '.img')
+        try:
+            with open(name, 'rb') as f:
+                blob = f.read()
+            os.utime(name)      # mtime is the LRU order
+        except OSError:
+            return None
+        if not blob.startswith(IMAGE_MAGIC):
+            return None
+        pos = len(IMAGE_MAGIC)
+        exec_address, count = IMAGE_HEADER.unpack_from(blob, pos)
+        pos += IMAGE_HEADER.size
+        ifdata = InfileData()
+        ifdata.execAddress = None if exec_address < 0 else exec_address
+        for i in range(count):
+            block = InfileDataBlock()
+            block.address, block.length = IMAGE_SEGMENT.unpack_from(blob, pos)
+            pos += IMAGE_SEGMENT.size
+            h = blob[pos:pos + block.length].hex()
+            block.data = [h[j:j + 2] for j in range(0, len(h), 2)]
+            pos += block.length
+            ifdata.blocks.append(block)
+        if self.verbose > 0:
+            print("Using cached image %s" % key[:16])
+        return ifdata
+
+    def store(self, key, ifdata):
+        """add a parsed image and evict old ones if the cache is full"""
+        parts = [IMAGE_MAGIC, IMAGE_HEADER.pack(
+            -1 if ifdata.execAddress is None else ifdata.execAddress,
+            len(ifdata.blocks))]
+        for block in ifdata.blocks:
+            parts.append(IMAGE_SEGMENT.pack(block.address, block.length))
+            parts.append(binascii.unhexlify(''.join(block.data)))
+        self._write(key + '.img', b''.join(parts))
+        self.evict()
+
+    def evict(self):
+        """remove least recently used images until the cache fits max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.img'):
+                try:
+                    st = os.stat(self._path(name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+            total -= size
+
+
+#------------------------------------
+#
+# Compressed Upload
+#
+#------------------------------------
+
+# LZ format expanded by the stub below, a sequence of tokens:
+#   00        end of data
+#   01..7F    that many literal bytes follow
+#   80..FF    copy (token & 7F) + 3 bytes from a 16 bit little endian
+#             distance back in the output, the copy may overlap itself
+LZ_MAX_LITERALS = 0x7F
+LZ_MIN_MATCH = 3
+LZ_MAX_MATCH = 0x7F + LZ_MIN_MATCH
+LZ_MAX_DISTANCE = 0xFFFF
+
+# 65C02 decompressor, also runs on a 65816 in either mode. Assembled at
+# address 0 with its six zero page bytes (SRC, DST, CPY pointers) at 0,
+# build_decompress_stub() relocates it. The zero page bytes are saved on
+# the stack and restored, the stub returns to the bootloader with RTS.
+#
+#   00  08        start:   PHP
+#   01  E2 30              SEP #$30     ; NOP #$30 on a 65C02
+#   03  D8                 CLD
+#   04  A2 05              LDX #5
+#   06  B5 00     save:    LDA SRC,X
+#   08  48                 PHA
+#   09  CA                 DEX
+#   0A  10 FA              BPL save
+#   0C  AD 98 00           LDA src_lo
+#   0F  85 00              STA SRC
+#   11  AD 99 00           LDA src_hi
+#   14  85 01              STA SRC+1
+#   16  AD 9A 00           LDA dst_lo
+#   19  85 02              STA DST
+#   1B  AD 9B 00           LDA dst_hi
+#   1E  85 03              STA DST+1
+#   20  9C 9C 00           STZ sum_lo
+#   23  9C 9D 00           STZ sum_hi
+#   26  B2 00     token:   LDA (SRC)
+#   28  20 7C 00           JSR inc_src
+#   2B  AA                 TAX
+#   2C  F0 38              BEQ done
+#   2E  30 0D              BMI match
+#   30  B2 00     lit:     LDA (SRC)
+#   32  20 7C 00           JSR inc_src
+#   35  20 83 00           JSR put
+#   38  CA                 DEX
+#   39  D0 F5              BNE lit
+#   3B  80 E9              BRA token
+#   3D  29 7F     match:   AND #$7F
+#   3F  18                 CLC
+#   40  69 03              ADC #3
+#   42  AA                 TAX
+#   43  38                 SEC
+#   44  A5 02              LDA DST
+#   46  F2 00              SBC (SRC)
+#   48  85 04              STA CPY
+#   4A  20 7C 00           JSR inc_src
+#   4D  A5 03              LDA DST+1
+#   4F  F2 00              SBC (SRC)
+#   51  85 05              STA CPY+1
+#   53  20 7C 00           JSR inc_src
+#   56  B2 04     copy:    LDA (CPY)
+#   58  20 83 00           JSR put
+#   5B  E6 04              INC CPY
+#   5D  D0 02              BNE copy2
+#   5F  E6 05              INC CPY+1
+#   61  CA        copy2:   DEX
+#   62  D0 F2              BNE copy
+#   64  80 C0              BRA token
+#   66  A5 02     done:    LDA DST
+#   68  8D 9A 00           STA dst_lo
+#   6B  A5 03              LDA DST+1
+#   6D  8D 9B 00           STA dst_hi
+#   70  A2 00              LDX #0
+#   72  68        rest:    PLA
+#   73  95 00              STA SRC,X
+#   75  E8                 INX
+#   76  E0 06              CPX #6
+#   78  D0 F8              BNE rest
+#   7A  28                 PLP
+#   7B  60                 RTS
+#   7C  E6 00     inc_src: INC SRC
+#   7E  D0 02              BNE isrc2
+#   80  E6 01              INC SRC+1
+#   82  60        isrc2:   RTS
+#   83  92 02     put:     STA (DST)
+#   85  18                 CLC
+#   86  6D 9C 00           ADC sum_lo
+#   89  8D 9C 00           STA sum_lo
+#   8C  90 03              BCC put2
+#   8E  EE 9D 00           INC sum_hi
+#   91  E6 02     put2:    INC DST
+#   93  D0 02              BNE put3
+#   95  E6 03              INC DST+1
+#   97  60        put3:    RTS
+#   98  00 00     src_lo/hi: compressed data, set by the host
+#   9A  00 00     dst_lo/hi: destination, the end of the output afterwards
+#   9C  00 00     sum_lo/hi: 16 bit sum of the output bytes
+DECOMPRESS_STUB = bytes.fromhex(
+    '08e230d8a205b50048ca10faad98008500ad99008501ad9a008502ad9b0085039c9c00'
+    '9c9d00b200207c00aaf038300db200207c00208300cad0f580e9297f186903aa38a502'
+    'f2008504207c00a503f2008505207c00b204208300e604d002e605cad0f280c0a5028d'
+    '9a00a5038d9b00a200689500e8e006d0f82860e600d002e601609202186d9c008d9c00'
+    '9003ee9d00e602d002e60360000000000000')
+# offsets of the absolute addresses and of the zero page operands
+DECOMPRESS_STUB_ABS = (13, 18, 23, 28, 33, 36, 41, 51, 54, 75, 84, 89, 105,
+                       110, 135, 138, 143)
+DECOMPRESS_STUB_ZP = (7, 16, 21, 26, 31, 39, 49, 69, 71, 73, 78, 80, 82, 87,
+                      92, 96, 103, 108, 116, 125, 129, 132, 146, 150)
+DECOMPRESS_PARAMS = 0x98
+# zero page bytes used by the stubs (saved and restored)
+STUB_ZP = 0xF0
+# generous upper bound of a stub run time per byte (200 cycles at 1 MHz)
+STUB_SECONDS_PER_BYTE = 2e-4
+
+
+def relocate_stub(stub, absolute, zero_page, origin, zp=STUB_ZP):
+    """a stub assembled at 0 with zero page 0 moved to origin (bank 0) and zp"""
+    stub = bytearray(stub)
+    for offset in absolute:
+        value = int.from_bytes(stub[offset:offset + 2], 'little') + origin
+        stub[offset:offset + 2] = value.to_bytes(2, 'little')
+    for offset in zero_page:
+        stub[offset] += zp
+    return bytes(stub)
+
+
+def build_decompress_stub(origin, zp=STUB_ZP):
+    """the decompressor stub relocated to origin and zero page zp..zp+5"""
+    return relocate_stub(DECOMPRESS_STUB, DECOMPRESS_STUB_ABS, DECOMPRESS_STUB_ZP,
+                         origin, zp)
+
+
+def run_stub(emc, address, result, length, work):
+    """\
+    Execute the stub at address and read length result bytes at result
+    once it returned, work is the number of bytes it processes.
+    """
+    emc.write_bin_command(EMC_EXECUTE_MEM_COMMAND)
+    emc.write_bytes(address.to_bytes(3, 'little'))
+    # the next command waits in the USB FIFO until the stub returns
+    timeout = emc.serial.timeout
+    if timeout is not None:
+        emc.serial.timeout = max(timeout, 1 + work * STUB_SECONDS_PER_BYTE)
+    try:
+        return emc.read_mem(result, length)
+    finally:
+        emc.serial.timeout = timeout
+
+
+def lz_compress(data):
+    """compress data for the decompressor stub (greedy, hash chains of 3 bytes)"""
+    out = bytearray()
+    literals = bytearray()
+    chains = {}
+    end = len(data)
+
+    def flush():
+        for i in range(0, len(literals), LZ_MAX_LITERALS):
+            part = literals[i:i + LZ_MAX_LITERALS]
+            out.append(len(part))
+            out.extend(part)
+        del literals[:]
+
+    pos = 0
+    while pos < end:
+        best_length = best_distance = 0
+        limit = min(LZ_MAX_MATCH, end - pos)
+        if limit >= LZ_MIN_MATCH:
+            for candidate in reversed(chains.get(data[pos:pos + 3], [])[-32:]):
+                distance = pos - candidate
+                if distance > LZ_MAX_DISTANCE:
+                    break
+                length = LZ_MIN_MATCH
+                while length < limit and data[candidate + length] == data[pos + length]:
+                    length += 1
+                if length > best_length:
+                    best_length, best_distance = length, distance
+                    if length == limit:
+                        break
+        if best_length:
+            flush()
+            out.append(0x80 | (best_length - LZ_MIN_MATCH))
+            out.extend(best_distance.to_bytes(2, 'little'))
+            step = best_length
+        else:
+            literals.append(data[pos])
+            step = 1
+        for i in range(pos, min(pos + step, end - 2)):
+            chains.setdefault(data[i:i + 3], []).append(i)
+        pos += step
+    flush()
+    out.append(0)
+    return bytes(out)
+
+
+def lz_decompress(data, offset=0):
+    """\
+    Reference decompressor, returns (output, offset after the end token).
+    Raises ValueError on truncated data or a copy before the output start.
+    """
+    out = bytearray()
+    try:
+        while True:
+            token = data[offset]
+            offset += 1
+            if token == 0:
+                return bytes(out), offset
+            if token < 0x80:
+                if offset + token > len(data):
+                    raise IndexError
+                out.extend(data[offset:offset + token])
+                offset += token
+            else:
+                distance = int.from_bytes(data[offset:offset + 2], 'little')
+                offset += 2
+                if not 0 < distance <= len(out):
+                    raise ValueError('copy from before the start at offset %d' % offset)
+                start = len(out) - distance
+                for i in range(start, start + (token & 0x7F) + LZ_MIN_MATCH):
+                    out.append(out[i])
+    except IndexError:
+        raise ValueError('truncated compressed data')
+
+
+def upload_compressed(emc, ifdata, scratch, policy=None):
+    """\
+    Write the blocks of a parsed file to memory, bank 0 blocks that shrink
+    are sent compressed and expanded by the stub at scratch, followed by
+    the compressed data. Exits on error.
+    """
+    stub = build_decompress_stub(scratch)
+    plain = []
+    packed = []
+    for block in ifdata.blocks:
+        data = binascii.unhexlify(''.join(block.data))
+        payload = lz_compress(data) if block.address < 0x10000 else data
+        if len(payload) < len(data):
+            packed.append((block.address, data, payload))
+        else:
+            plain.append(block)
+    if packed:
+        buffer = scratch + len(stub)
+        end = buffer + max(len(payload) for address, data, payload in packed)
+        if end > 0x10000:
+            print("Error: compressed data does not fit in bank 0 at 0x%06X" % scratch)
+            sys.exit(1)
+        for block in ifdata.blocks:
+            if block.address < end and scratch < block.address + block.length:
+                print("Error: decompressor area 0x%06X-0x%06X overlaps the image" % (
+                    scratch, end - 1))
+                sys.exit(1)
+        total = sum(len(data) for address, data, payload in packed)
+        sent = sum(len(payload) for address, data, payload in packed)
+        print("Compressed upload: %d bytes in %d blocks sent as %d bytes (%.1f%%)" % (
+            total, len(packed), sent, 100.0 * sent / total))
+        stub_data = InfileData()
+        stub_data.blocks = [data_block(scratch, stub)]
+        upload_to_memory(emc, stub_data, policy)
+    for address, data, payload in packed:
+        if emc.verbose:
+            print("Expanding %d bytes to 0x%06X" % (len(data), address))
+        payload_data = InfileData()
+        payload_data.blocks = [data_block(buffer, payload)]
+        upload_to_memory(emc, payload_data, policy)
+        params = scratch + DECOMPRESS_PARAMS
+        if emc.write_mem(params, buffer.to_bytes(2, 'little') +
+                         address.to_bytes(2, 'little') + b'\x00\x00') != b'\x00':
+            print("Error: Failed to set up the decompressor")
+            sys.exit(1)
+        result = run_stub(emc, scratch, params + 2, 4, len(data))
+        expected = ((address + len(data)) & 0xFFFF).to_bytes(2, 'little') + (
+            sum(data) & 0xFFFF).to_bytes(2, 'little')
+        if result != expected:
+            print("Error: decompressed block at 0x%06X does not match (%s, expected %s)" % (
+                address, binascii.hexlify(result).decode().upper(),
+                binascii.hexlify(expected).decode().upper()))
+            sys.exit(1)
+    if plain:
+        plain_data = InfileData()
+        plain_data.blocks = plain
+        upload_to_memory(emc, plain_data, policy)
+
+
+#------------------------------------
+#
+# Upload Verification
+#
+#------------------------------------
+
+# 65C02 CRC-16/CCITT (polynomial 1021, initial value FFFF) over a table of
+# ranges (address, length, 16 bit each) ended by a zero length. The byte
+# loop is the table-less CRC by Greg Cook. Assembled and relocated like
+# the decompressor stub, PTR, CNT and TBL are the six zero page bytes.
+#
+#   00  08        start:   PHP
+#   01  E2 30              SEP #$30     ; NOP #$30 on a 65C02
+#   03  D8                 CLD
+#   04  A2 05              LDX #5
+#   06  B5 00     save:    LDA PTR,X
+#   08  48                 PHA
+#   09  CA                 DEX
+#   0A  10 FA              BPL save
+#   0C  AD 97 00           LDA tbl_lo
+#   0F  85 04              STA TBL
+#   11  AD 98 00           LDA tbl_hi
+#   14  85 05              STA TBL+1
+#   16  A9 FF              LDA #$FF
+#   18  8D 99 00           STA crc_lo
+#   1B  8D 9A 00           STA crc_hi
+#   1E  B2 04     range:   LDA (TBL)
+#   20  85 00              STA PTR
+#   22  20 90 00           JSR inc_tbl
+#   25  B2 04              LDA (TBL)
+#   27  85 01              STA PTR+1
+#   29  20 90 00           JSR inc_tbl
+#   2C  B2 04              LDA (TBL)
+#   2E  85 02              STA CNT
+#   30  20 90 00           JSR inc_tbl
+#   33  B2 04              LDA (TBL)
+#   35  85 03              STA CNT+1
+#   37  20 90 00           JSR inc_tbl
+#   3A  05 02              ORA CNT
+#   3C  F0 46              BEQ done
+#   3E  B2 00     byte:    LDA (PTR)
+#   40  4D 9A 00           EOR crc_hi
+#   43  8D 9A 00           STA crc_hi
+#   46  4A                 LSR
+#   47  4A                 LSR
+#   48  4A                 LSR
+#   49  4A                 LSR
+#   4A  AA                 TAX
+#   4B  0A                 ASL
+#   4C  4D 99 00           EOR crc_lo
+#   4F  8D 99 00           STA crc_lo
+#   52  8A                 TXA
+#   53  4D 9A 00           EOR crc_hi
+#   56  8D 9A 00           STA crc_hi
+#   59  0A                 ASL
+#   5A  0A                 ASL
+#   5B  0A                 ASL
+#   5C  AA                 TAX
+#   5D  0A                 ASL
+#   5E  0A                 ASL
+#   5F  4D 9A 00           EOR crc_hi
+#   62  A8                 TAY
+#   63  8A                 TXA
+#   64  2A                 ROL
+#   65  4D 99 00           EOR crc_lo
+#   68  8D 9A 00           STA crc_hi
+#   6B  8C 99 00           STY crc_lo
+#   6E  E6 00              INC PTR
+#   70  D0 02              BNE b2
+#   72  E6 01              INC PTR+1
+#   74  A5 02     b2:      LDA CNT
+#   76  D0 02              BNE b3
+#   78  C6 03              DEC CNT+1
+#   7A  C6 02     b3:      DEC CNT
+#   7C  D0 C0              BNE byte
+#   7E  A5 03              LDA CNT+1
+#   80  D0 BC              BNE byte
+#   82  80 9A              BRA range
+#   84  A2 00     done:    LDX #0
+#   86  68        rest:    PLA
+#   87  95 00              STA PTR,X
+#   89  E8                 INX
+#   8A  E0 06              CPX #6
+#   8C  D0 F8              BNE rest
+#   8E  28                 PLP
+#   8F  60                 RTS
+#   90  E6 04     inc_tbl: INC TBL
+#   92  D0 02              BNE it2
+#   94  E6 05              INC TBL+1
+#   96  60        it2:     RTS
+#   97  00 00     tbl_lo/hi: range table, set by the host
+#   99  00 00     crc_lo/hi: the CRC afterwards
+CHECKSUM_STUB = bytes.fromhex(
+    '08e230d8a205b50048ca10faad97008504ad98008505a9ff8d99008d9a00b204850020'
+    '9000b2048501209000b2048502209000b20485032090000502f046b2004d9a008d9a00'
+    '4a4a4a4aaa0a4d99008d99008a4d9a008d9a000a0a0aaa0a0a4d9a00a88a2a4d99008d'
+    '9a008c9900e600d002e601a502d002c603c602d0c0a503d0bc809aa200689500e8e006'
+    'd0f82860e604d002e6056000000000')
+CHECKSUM_STUB_ABS = (13, 18, 25, 28, 35, 42, 49, 56, 65, 68, 77, 80, 84, 87,
+                     96, 102, 105, 108)
+CHECKSUM_STUB_ZP = (7, 16, 21, 31, 33, 38, 40, 45, 47, 52, 54, 59, 63, 111,
+                    115, 117, 121, 123, 127, 136, 145, 149)
+CHECKSUM_PARAMS = 0x97
+# bytes read back at a time by --verify readback
+READBACK_SIZE = 4096
+
+
+def build_checksum_stub(origin, zp=STUB_ZP):
+    """the checksum stub relocated to origin and zero page zp..zp+5"""
+    return relocate_stub(CHECKSUM_STUB, CHECKSUM_STUB_ABS, CHECKSUM_STUB_ZP,
+                         origin, zp)
+
+
+def parse_verify(text):
+    """parse readback or checksum:ADDR for --verify, returns (method, address)"""
+    method, _, address = text.partition(':')
+    if method == 'readback' and not address:
+        return method, None
+    if method == 'checksum' and address:
+        return method, parse_address(address)
+    raise ValueError(text)
+
+
+def checksum_ranges(blocks):
+    """(address, length) ranges of the bank 0 blocks for the checksum stub"""
+    ranges = []
+    for block in blocks:
+        if block.address < 0x10000:
+            for start in range(0, block.length, 0xFFFF):
+                ranges.append((block.address + start, min(0xFFFF, block.length - start)))
+    return ranges
+
+
+def verify_readback(emc, blocks):
+    """read the blocks back and compare them, exits on the first difference"""
+    for block in blocks:
+        data = binascii.unhexlify(''.join(block.data))
+        for pos in range(0, len(data), READBACK_SIZE):
+            expected = data[pos:pos + READBACK_SIZE]
+            result = emc.read_mem(block.address + pos, len(expected))
+            if result != expected:
+                diff = next((i for i, (a, b) in enumerate(zip(result, expected)) if a != b),
+                            len(result))
+                print("Error: verify failed at 0x%06X" % (block.address + pos + diff))
+                sys.exit(1)
+
+
+def verify_memory(emc, ifdata, method, scratch=None):
+    """\
+    Verify an upload. readback reads every byte back, checksum runs the CRC
+    stub at scratch over the bank 0 blocks and reads back two bytes, the
+    blocks outside bank 0 are read back. Exits on error.
+    """
+    blocks = ifdata.blocks
+    ranges = checksum_ranges(blocks) if method == 'checksum' else []
+    if ranges:
+        table = b''.join(address.to_bytes(2, 'little') + length.to_bytes(2, 'little')
+                         for address, length in ranges) + bytes(4)
+        end = scratch + len(CHECKSUM_STUB) + len(table)
+        if end > 0x10000:
+            print("Error: checksum stub does not fit in bank 0 at 0x%06X" % scratch)
+            sys.exit(1)
+        for block in blocks:
+            if block.address < end and scratch < block.address + block.length:
+                print("Error: checksum stub area 0x%06X-0x%06X overlaps the image" % (
+                    scratch, end - 1))
+                sys.exit(1)
+        stub = bytearray(build_checksum_stub(scratch))
+        stub[CHECKSUM_PARAMS:CHECKSUM_PARAMS + 2] = (
+            scratch + len(stub)).to_bytes(2, 'little')
+        if emc.write_mem(scratch, bytes(stub) + table) != b'\x00':
+            print("Error: Failed to write the checksum stub")
+            sys.exit(1)
+        crc = 0xFFFF
+        for block in blocks:
+            if block.address < 0x10000:
+                crc = binascii.crc_hqx(binascii.unhexlify(''.join(block.data)), crc)
+        total = sum(length for address, length in ranges)
+        result = run_stub(emc, scratch, scratch + CHECKSUM_PARAMS + 2, 2, total)
+        if result != crc.to_bytes(2, 'little'):
+            print("Error: verify failed, CRC %s, expected %04X" % (
+                binascii.hexlify(result[::-1]).decode().upper(), crc))
+            sys.exit(1)
+        blocks = [block for block in blocks if block.address >= 0x10000]
+    verify_readback(emc, blocks)
+    print("Verified %d bytes" % sum(block.length for block in ifdata.blocks))
+
+
+# the flash is mapped at 0x8000-0xFFFF
+FLASH_START = 0x8000
+FLASH_SIZE = 0x8000
+# bytes per EMC_READ_FLASH when comparing the flash with an image
+FLASH_READ_CHUNK = 1024
+# bytes sent between flash write progress updates
+FLASH_PROGRESS_STEP = 1024
+# generous upper bound of the programming time per byte (typically 20 us)
+FLASH_SECONDS_PER_BYTE = 1e-4
+# times a chunk is sent again after an error status
+FLASH_RETRIES = 3
+
+
+def flash_image(ifdata, size=FLASH_SIZE):
+    """\
+    The bytes programmed for an image: from 0x8000 up to the end of its
+    last block, gaps are 00. Exits if the image does not start at 0x8000
+    or does not fit into size bytes of flash.
+    """
+    blocks = ifdata.blocks
+    if not blocks or min(block.address for block in blocks) != FLASH_START:
+        print("Error: the image does not start at 0x8000")
+        sys.exit(1)
+    end = max(block.address + block.length for block in blocks)
+    if end > FLASH_START + size:
+        print("Error: the image ends at 0x%06X, beyond the flash" % (end - 1))
+        sys.exit(1)
+    image = bytearray(end - FLASH_START)
+    for block in blocks:
+        offset = block.address - FLASH_START
+        image[offset:offset + block.length] = binascii.unhexlify(''.join(block.data))
+    return bytes(image)
+
+
+def flash_holds(emc, image):
+    """\
+    True if the flash holds image. Reads it with one EMC_READ_FLASH from
+    0x8000, like read mode, and compares the reply as it arrives.
+    """
+    same = True
+    pos = 0
+    for chunk in emc.read_flash_chunks(0, len(image)):
+        # after a difference the rest of the reply is still read
+        if same and chunk != image[pos:pos + len(chunk)]:
+            log.info('flash differs from the image in 0x%06X-0x%06X',
+                     FLASH_START + pos, FLASH_START + pos + len(chunk) - 1)
+            same = False
+        pos += len(chunk)
+    return same and pos == len(image)
+
+
+def flash_resume(emc, image):
+    """\
+    Compare the flash with image in chunks, for bootloaders that take
+    several write frames (BoardProfile.flash_chunk). Returns the offset of
+    the first chunk that differs (the image length if the flash holds the
+    image) or None if the flash has to be cleared. From the first
+    difference on the flash is only read while it can still be programmed
+    without a clear, that is while it has no 0 bit where the image has a 1.
+    """
+    resume = None
+    for offset in range(0, len(image), FLASH_READ_CHUNK):
+        expected = image[offset:offset + FLASH_READ_CHUNK]
+        flash = emc.read_flash(offset, len(expected))
+        if flash == expected:
+            continue
+        if resume is None:
+            log.info('flash differs from the image in 0x%06X-0x%06X',
+                     FLASH_START + offset, FLASH_START + offset + len(expected) - 1)
+            resume = offset
+        wanted = int.from_bytes(expected, 'big')
+        if len(flash) != len(expected) or int.from_bytes(flash, 'big') & wanted != wanted:
+            log.info('flash needs a clear for 0x%06X-0x%06X',
+                     FLASH_START + offset, FLASH_START + offset + len(expected) - 1)
+            return None
+    return len(image) if resume is None else resume
+
+
+def flash_deadline(serial, length):
+    """seconds to wait for the status of an EMC_WRITE_FLASH frame of length bytes"""
+    return 1 + length * (10.0 / serial.baudrate + FLASH_SECONDS_PER_BYTE)
+
+
+def flash_program(emc, image, offset=0, chunk_size=None):
+    """\
+    Program image from offset on in EMC_WRITE_FLASH frames of chunk_size
+    bytes (None: one frame) and print the progress. A frame with an error
+    status is sent again up to FLASH_RETRIES times. Exits if it still fails
+    or no status arrives in time; with several frames the next write
+    resumes from the failed one (see flash_resume).
+    """
+    def progress(sent):
+        done = start + sent
+        sys.stdout.write("\r%d of %d bytes (%d%%)" % (done, len(image),
+                                                     100 * done // len(image)))
+        sys.stdout.flush()
+
+    for start in range(offset, len(image), chunk_size or len(image)):
+        chunk = image[start:start + (chunk_size or len(image))]
+        timeout = flash_deadline(emc.serial, len(chunk))
+        for attempt in range(FLASH_RETRIES + 1):
+            status = emc.write_flash(FLASH_START + start, chunk, timeout, progress)
+            if status and status != b'\x00':
+                log.info('WRITE_FLASH at 0x%06X returned %s, attempt %d',
+                         FLASH_START + start, HexArg(status), attempt + 1)
+                continue
+            break
+        if status != b'\x00':
+            print("\nError: writing flash at 0x%06X failed (%s)" % (
+                FLASH_START + start, status.hex().upper() if status else
+                "no status within %.1f s" % timeout))
+            if chunk_size:
+                print("Write again to resume from there")
+            sys.exit(1)
+    print()
+
+
+def upload_to_memory(emc, ifdata, policy=None, compress=None):
+    """\
+    write all blocks of a parsed file to memory, exits on error. compress
+    is the scratch address for a compressed upload (see upload_compressed)
+    """
+    if compress is not None:
+        upload_compressed(emc, ifdata, compress, policy)
+        return
+    if policy is None:
+        policy = FramePolicy()
+    for address, data in policy.frames(ifdata.blocks):
+        resp = emc.write_mem(address, data)
+        if resp != b'\x00':
+            print("Error: %s Failed Write Bytes in Memmory" % (
+                binascii.hexlify(resp).decode().upper()))
+            sys.exit(1)
+
+
+def execute_memory(emc, address, capture=False):
+    """\
+    Execute the program at address. With capture, reading the serial port
+    starts right before the last byte of the command is sent and the
+    RxCapture is returned.
+    """
+    addrs = num2le(address, 3)
+    print("\nExecuting program at address 0x%06X in memory" % address)
+    emc.write_bin_command(EMC_EXECUTE_MEM_COMMAND)
+    rx = RxCapture(emc.serial) if capture else None
+    for d in addrs:
+        emc.write_serial(d)
+    return rx
+
+
+def make_trigger_action(name, value, miniterm, emc, ifdata=None, execute=False,
+                        policy=None, compress=None):
+    """return the function run by the terminal when a trigger matches"""
+    def report(text):
+        sys.stderr.write('\n--- trigger {!r}: {} ---\n'.format(text, name))
+
+    if name == 'exit':
+        def action(text):
+            report(text)
+            miniterm.quit(value)
+    elif name == 'send':
+        def action(text):
+            miniterm.write_tx(miniterm.tx_encoder.encode(value))
+    else:
+        def bootloader(text):
+            # the bootloader answers are read directly, discard what the
+            # board printed so far
+            report(text)
+            miniterm.serial.reset_input_buffer()
+            if name == 'upload':
+                upload_to_memory(emc, ifdata, policy, compress)
+                if execute:
+                    execute_memory(emc, ifdata.execAddress)
+            else:
+                address, length = value
+                for line in hexdump(emc.read_mem_chunks(address, length), address):
+                    sys.stderr.write(line + '\n')
+
+        def action(text):
+            try:
+                bootloader(text)
+            except SystemExit as e:
+                miniterm.quit(e.code)
+    return action
+
+#------------------------------------
+#
+# Board Profiles
+#
+#------------------------------------
+
+# vectors that must not be 0 in an update image
+VECTORS_65C02 = (0xFFFA, 0xFFFC, 0xFFFE)
+VECTORS_65C816 = (0xFFF4, 0xFFF6, 0xFFF8, 0xFFFA, 0xFFFC, 0xFFFE)
+
+
+class BoardProfile(object):
+    """\
+    Transfer settings for a kind of board:
+      name      shown after the board info
+      frames    default --block-size
+      baudrate  highest baud rate known to work, None for USB FIFO links
+      timeout   port timeout in seconds while waiting for a reply
+      rtscts    RTS/CTS flow control
+      low_latency  tune the port for latency (see tune_low_latency)
+      flash     bytes of flash the bootloader programs from 0x8000
+      flash_chunk  bytes per EMC_WRITE_FLASH frame for bootloaders known to
+                take several, None for one frame (no resuming)
+      vectors   vectors that must not be 0 in an update image
+    """
+
+    SETTINGS = ('name', 'frames', 'baudrate', 'timeout', 'flash', 'flash_chunk',
+                'vectors', 'rtscts', 'low_latency')
+
+    def __init__(self, **settings):
+        self.name = 'generic'
+        self.frames = 'max'
+        self.baudrate = None
+        self.timeout = 1
+        self.flash = FLASH_SIZE
+        self.flash_chunk = None
+        self.vectors = ()
+        self.rtscts = True
+        self.low_latency = False
+        self.update(settings)
+
+    def update(self, settings):
+        for key, value in settings.items():
+            if key not in self.SETTINGS:
+                raise ValueError('unknown board profile setting %r' % key)
+            setattr(self, key, value)
+
+    def apply(self, args, ser):
+        """use the profile for what the command line leaves open"""
+        if args.block_size is None:
+            args.block_size = FramePolicy(self.frames)
+        if self.baudrate and args.baudrate > self.baudrate:
+            print("Warning: %s boards are known to work up to %d baud" % (
+                self.name, self.baudrate))
+        ser.timeout = self.timeout
+        if ser.rtscts != self.rtscts:
+            ser.rtscts = self.rtscts
+
+# (board, cpu, minimum hardware version, minimum software version, settings)
+# as reported by EMC_BOARD_INFO, versions in 1/100. None matches anything,
+# the settings of all matching entries are applied in this order.
+BOARD_PROFILES = [
+    (None, '2', None, None, {'name': 'W65C02', 'vectors': VECTORS_65C02}),
+    (None, '6', None, None, {'name': 'W65C816', 'vectors': VECTORS_65C816}),
+    ('SXB', '2', None, None, {'name': 'W65C02SXB'}),
+    ('SXB', '6', None, None, {'name': 'W65C816SXB'}),
+    ('MYA', None, None, None, {'name': 'Mymensch A'}),
+    ('MYB', None, None, None, {'name': 'Mymensch B'}),
+    ('MYC', None, None, None, {'name': 'Mymensch C'}),
+]
+
+
+def load_profiles(path):
+    """\
+    Board profile entries from a JSON file: a list of objects with the
+    optional keys board, cpu, hw and sw and any BoardProfile settings.
+    """
+    entries = []
+    with open(path) as f:
+        for item in json.load(f):
+            item = dict(item)
+            key = tuple(item.pop(name, None) for name in ('board', 'cpu', 'hw', 'sw'))
+            BoardProfile(**item)
+            entries.append(key + (item,))
+    return entries
+
+
+def select_profile(board=None, cpu=None, hw=None, sw=None, entries=()):
+    """the BoardProfile for a board, entries are tried after BOARD_PROFILES"""
+    profile = BoardProfile()
+    for e_board, e_cpu, e_hw, e_sw, settings in BOARD_PROFILES + list(entries):
+        if e_board is not None and e_board != board:
+            continue
+        if e_cpu is not None and e_cpu != cpu:
+            continue
+        if e_hw is not None and (hw is None or hw < e_hw):
+            continue
+        if e_sw is not None and (sw is None or sw < e_sw):
+            continue
+        profile.update(settings)
+    return profile
+
+#------------------------------------
+#
+# EMC Board Stand-in
+#
+#------------------------------------
+
+class FakeSerial(object):
+    """the settings and no-op methods of a serial port, for stand-ins"""
+
+    def __init__(self, url):
+        self.name = url
+        self.port = url
+        self.baudrate = 115200
+        self.bytesize = 8
+        self.parity = 'N'
+        self.stopbits = 1
+        self.timeout = 1
+        self.interCharTimeout = None
+        self.rtscts = False
+        self.xonxoff = False
+        self.dtr = False
+        self.rts = False
+        self.break_condition = False
+        self.cts = self.dsr = self.cd = True
+        self.ri = False
+        self.is_open = False
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def flush(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+
+class EMCBoardSim(FakeSerial):
+    """\
+    Serial port stand-in for a board running the WDC bootloader.
+
+    Selected with a device of the form sim://[?option=value&...]:
+      cpu=2|6     CPU type reported by EMC_BOARD_INFO (default 6)
+      latency=S   seconds before each reply becomes readable (default 0)
+      paced=1     delay reads and writes as if sent at the set baud rate
+      output=TEXT text the "program" prints when executed from memory
+    """
+
+    HW_VERSION = 100
+    SW_VERSION = 100
+
+    def __init__(self, url='sim://'):
+        super(EMCBoardSim, self).__init__(url)
+        options = dict(parse_qsl(urlparse(url).query))
+        self.cpu = options.get('cpu', '6')
+        self.latency = float(options.get('latency', 0))
+        self.paced = options.get('paced', '0') not in ('', '0')
+        self.output = options.get('output', '').encode('utf-8')
+        self.memory = bytearray(0x1000000)
+        self.flash = bytearray(b'\xff' * 0x8000)
+        # called with the address on EMC_EXECUTE_MEM, keyed by address
+        self.exec_hooks = {}
+        self._input = bytearray()
+        self._output = bytearray()
+        self._ready_at = 0
+        self._cancelled = False
+        self._cond = threading.Condition()
+        self._handlers = {
+            0x00: self._do_sync,
+            0x01: self._do_echo,
+            0x02: self._do_write_mem,
+            0x03: self._do_read_mem,
+            0x06: self._do_execute_mem,
+            0x07: self._do_write_flash,
+            0x08: self._do_read_flash,
+            0x09: self._do_clear_flash,
+            0x0A: self._do_check_flash,
+            0x0C: self._do_board_info,
+        }
+        self._protocol = self._run()
+        self._need = next(self._protocol)
+
+    def reset_input_buffer(self):
+        with self._cond:
+            del self._output[:]
+
+    def cancel_read(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def clear_cancel_read(self):
+        with self._cond:
+            self._cancelled = False
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            if monotonic() < self._ready_at:
+                return 0
+            return len(self._output)
+
+    def _line_delay(self, count):
+        if self.paced and count:
+            sleep(count * 10.0 / self.baudrate)
+
+    def write(self, data):
+        data = bytes(data)
+        self._line_delay(len(data))
+        self._input.extend(data)
+        while len(self._input) >= self._need:
+            chunk = bytes(self._input[:self._need])
+            del self._input[:self._need]
+            self._need = self._protocol.send(chunk)
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        with self._cond:
+            while not self._cancelled:
+                now = monotonic()
+                if now >= self._ready_at and len(self._output) >= size:
+                    break
+                if deadline is not None and now >= deadline:
+                    break
+                wait = self._ready_at - now if now < self._ready_at else None
+                if deadline is not None:
+                    wait = min(wait or deadline - now, deadline - now)
+                self._cond.wait(wait)
+            self._cancelled = False
+            if monotonic() < self._ready_at:
+                return b''
+            data = bytes(self._output[:size])
+            del self._output[:size]
+        self._line_delay(len(data))
+        return data
+
+    def respond(self, data):
+        """queue bytes sent by the board"""
+        with self._cond:
+            self._output.extend(data)
+            if self.latency:
+                self._ready_at = monotonic() + self.latency
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            if (yield 1) != b'\x55':
+                continue
+            if (yield 1) != b'\xaa':
+                continue
+            self.respond(b'\xcc')
+            handler = self._handlers.get((yield 1)[0])
+            if handler is not None:
+                yield from handler()
+
+    def _read_address(self):
+        return int.from_bytes((yield 3), 'little')
+
+    def _do_sync(self):
+        self.respond(b'\x00')
+        return
+        yield
+
+    def _do_echo(self):
+        self.respond((yield 1))
+
+    def _do_write_mem(self):
+        address = yield from self._read_address()
+        length = yield from self._read_address()
+        data = yield length
+        self.memory[address:address + length] = data[:0x1000000 - address]
+        self.respond(b'\x00')
+
+    def _do_read_mem(self):
+        address = yield from self._read_address()
+        length = yield from self._read_address()
+        self.respond(self.memory[address:address + length])
+
+    def _do_execute_mem(self):
+        address = yield from self._read_address()
+        hook = self.exec_hooks.get(address)
+        if hook is not None:
+            hook(address)
+        elif self.memory[address:address + DECOMPRESS_PARAMS] == \
+                build_decompress_stub(address & 0xFFFF)[:DECOMPRESS_PARAMS]:
+            self._decompress(address)
+        elif self.memory[address:address + CHECKSUM_PARAMS] == \
+                build_checksum_stub(address & 0xFFFF)[:CHECKSUM_PARAMS]:
+            self._checksum(address)
+        elif self.output:
+            self.respond(self.output)
+
+    def _decompress(self, address):
+        """what the decompressor stub at address does, bank 0 only"""
+        params = address + DECOMPRESS_PARAMS
+        src = int.from_bytes(self.memory[params:params + 2], 'little')
+        dst = int.from_bytes(self.memory[params + 2:params + 4], 'little')
+        data, end = lz_decompress(self.memory, src)
+        self.memory[dst:dst + len(data)] = data
+        self.memory[params + 2:params + 6] = (
+            ((dst + len(data)) & 0xFFFF).to_bytes(2, 'little') +
+            (sum(data) & 0xFFFF).to_bytes(2, 'little'))
+
+    def _checksum(self, address):
+        """what the checksum stub at address does, bank 0 only"""
+        params = address + CHECKSUM_PARAMS
+        table = int.from_bytes(self.memory[params:params + 2], 'little')
+        crc = 0xFFFF
+        while True:
+            start = int.from_bytes(self.memory[table:table + 2], 'little')
+            length = int.from_bytes(self.memory[table + 2:table + 4], 'little')
+            table += 4
+            if not length:
+                break
+            crc = binascii.crc_hqx(self.memory[start:start + length], crc)
+        self.memory[params + 2:params + 4] = crc.to_bytes(2, 'little')
+
+    def _do_write_flash(self):
+        address = (yield from self._read_address()) & 0x7FFF
+        length = yield from self._read_address()
+        data = yield length
+        # programming only clears bits, like the real flash
+        for i, value in enumerate(data[:0x8000 - address], address):
+            self.flash[i] &= value
+        self.respond(b'\x00')
+
+    def _do_read_flash(self):
+        address = (yield from self._read_address()) & 0x7FFF
+        length = yield from self._read_address()
+        self.respond(self.flash[address:address + length])
+
+    def _do_clear_flash(self):
+        self.flash[:] = b'\xff' * len(self.flash)
+        self.respond(b'\x00')
+        return
+        yield
+
+    def _do_check_flash(self):
+        self.respond(b'\x00')
+        return
+        yield
+
+    def _do_board_info(self):
+        self.respond(b'SXB' + self.cpu.encode()[:1] +
+                     self.HW_VERSION.to_bytes(4, 'little') +
+                     self.SW_VERSION.to_bytes(4, 'little'))
+        return
+        yield
+
+#------------------------------------
+#
+# Serial Trace
+#
+#------------------------------------
+
+# name and TX layout of the bootloader commands: 'addr' is a 3 byte
+# address, 'range' address and length, 'write' address, length and data.
+# The reply is a status byte, length bytes ('length'), 12 bytes of board
+# info or nothing.
+EMC_FRAMES = {
+    0x00: ('SYNC', None, 'status'),
+    0x01: ('ECHO', 'byte', 'byte'),
+    0x02: ('WRITE_MEM', 'write', 'status'),
+    0x03: ('READ_MEM', 'range', 'length'),
+    0x06: ('EXECUTE_MEM', 'addr', None),
+    0x07: ('WRITE_FLASH', 'write', 'status'),
+    0x08: ('READ_FLASH', 'range', 'length'),
+    0x09: ('CLEAR_FLASH', None, 'status'),
+    0x0A: ('CHECK_FLASH', None, 'status'),
+    0x0B: ('EXECUTE_FLASH', None, None),
+    0x0C: ('BOARD_INFO', None, 'info'),
+}
+
+
+class TracedSerial(object):
+    """\
+    Wrap an open serial port and record every byte written and read with
+    a SessionLog in its timestamped format. Everything else is passed on
+    to the port.
+    """
+
+    def __init__(self, serial_instance, log):
+        self.__dict__['_serial'] = serial_instance
+        self.__dict__['_log'] = log
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._serial, name, value)
+
+    def write(self, data):
+        self._log.tx(data)
+        return self._serial.write(data)
+
+    def read(self, size=1):
+        data = self._serial.read(size)
+        if data:
+            self._log.rx(data)
+        return data
+
+
+class Trace(object):
+    """\
+    The TX and RX byte streams of a timestamped log, with the time of
+    every chunk: tx_chunks/rx_chunks are lists of (offset, seconds).
+    """
+
+    def __init__(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            content = f.read()
+        if not content.startswith(LOG_MAGIC):
+            raise ValueError('%s is not a timestamped log' % path)
+        self.tx = bytearray()
+        self.rx = bytearray()
+        self.tx_chunks = []
+        self.rx_chunks = []
+        pos = len(LOG_MAGIC)
+        while pos + LOG_RECORD.size <= len(content):
+            direction, stamp, length = LOG_RECORD.unpack_from(content, pos)
+            pos += LOG_RECORD.size
+            data = content[pos:pos + length]
+            pos += length
+            stream, chunks = (self.tx, self.tx_chunks) if direction == b'T' else (
+                self.rx, self.rx_chunks)
+            chunks.append((len(stream), stamp))
+            stream.extend(data)
+
+    @staticmethod
+    def _time(chunks, index):
+        return chunks[bisect.bisect_right(chunks, (index, float('inf'))) - 1][1]
+
+    def tx_time(self, index):
+        """seconds from the start when TX byte index was sent"""
+        return self._time(self.tx_chunks, index)
+
+    def rx_time(self, index):
+        """seconds from the start when RX byte index was received"""
+        return self._time(self.rx_chunks, index)
+
+    def rx_before(self, stamp, start=0):
+        """index of the first RX byte from start on received at or after stamp"""
+        i = bisect.bisect_right(self.rx_chunks, (start, float('inf'))) - 1
+        for offset, chunk_stamp in self.rx_chunks[max(i, 0):]:
+            if chunk_stamp >= stamp:
+                return max(offset, start)
+        return len(self.rx)
+
+
+def decode_trace(trace):
+    """\
+    Split a Trace into bootloader frames. Generates (start, seconds, name,
+    details) with name None for other data sent or received.
+    """
+    tx, rx = trace.tx, trace.rx
+    ti = ri = 0
+    while ti < len(tx):
+        hs = tx.find(b'\x55\xaa', ti)
+        if hs < 0:
+            hs = len(tx)
+        if hs > ti:
+            yield trace.tx_time(ti), 0, None, 'TX %d bytes' % (hs - ti)
+            ti = hs
+            continue
+        start = trace.tx_time(hs)
+        output = trace.rx_before(start, ri)
+        if output > ri:
+            yield trace.rx_time(ri), start - trace.rx_time(ri), None, 'RX %d bytes' % (
+                output - ri)
+            ri = output
+        ti = hs + 2
+        end = trace.tx_time(hs + 1)
+        if rx[ri:ri + 1] != b'\xcc':
+            yield start, end - start, 'HANDSHAKE', 'no reply'
+            continue
+        end = trace.rx_time(ri)
+        ri += 1
+        if ti >= len(tx):
+            yield start, end - start, 'HANDSHAKE', 'no command'
+            break
+        command = tx[ti]
+        ti += 1
+        name, layout, reply = EMC_FRAMES.get(command, ('0x%02X' % command, None, None))
+        details = []
+        length = 0
+        fields = {'byte': 1, 'addr': 3, 'range': 6, 'write': 6}.get(layout, 0)
+        if ti + fields > len(tx):
+            yield start, end - start, name, 'truncated'
+            break
+        if layout == 'byte':
+            details.append('%02X' % tx[ti])
+        elif layout:
+            details.append('0x%06X' % int.from_bytes(tx[ti:ti + 3], 'little'))
+        if layout in ('range', 'write'):
+            length = int.from_bytes(tx[ti + 3:ti + 6], 'little')
+            details.append('%d bytes' % length)
+        ti += fields
+        if layout == 'write':
+            ti += length
+            end = trace.tx_time(min(ti, len(tx)) - 1)
+        size = {'status': 1, 'byte': 1, 'info': 12, 'length': length}.get(reply, 0)
+        if size:
+            data = rx[ri:ri + size]
+            if len(data) < size:
+                details.append('%d of %d reply bytes' % (len(data), size))
+            elif reply == 'status':
+                details.append('status %02X' % data[0])
+            elif reply == 'byte':
+                details.append('echo %02X' % data[0])
+            elif reply == 'info':
+                details.append(data[:4].decode('latin-1'))
+            if data:
+                end = trace.rx_time(ri + len(data) - 1)
+            ri += len(data)
+        if length and end > start:
+            details.append('%.0f B/s' % (length / (end - start)))
+        yield start, end - start, name, ', '.join(details)
+    if ri < len(rx):
+        yield trace.rx_time(ri), 0, None, 'RX %d bytes' % (len(rx) - ri)
+
+
+def print_trace(path):
+    """print the frames of a trace file with their timing"""
+    counts = {}
+    for start, seconds, name, details in decode_trace(Trace(path)):
+        print("%10.6f %9.3f ms  %-13s %s" % (start, seconds * 1000, name or '', details))
+        if name:
+            counts[name] = counts.get(name, 0) + 1
+    print("Frames: %s" % (', '.join('%s %d' % item for item in sorted(counts.items()))
+                          or 'none'))
+
+
+class TraceReplay(FakeSerial):
+    """\
+    Serial port that plays back the RX data of a trace. Received data
+    becomes readable once as many bytes were written as had been sent
+    before it in the recording. Writes that differ from the recorded TX
+    data are counted in mismatches.
+
+    Selected with a device of the form replay://FILE[?timing=1], timing
+    also keeps the recorded delay between the last write and a reply.
+    """
+
+    def __init__(self, url):
+        super(TraceReplay, self).__init__(url)
+        parts = urlparse(url)
+        options = dict(parse_qsl(parts.query))
+        self.trace = Trace(parts.netloc + parts.path)
+        self.timing = options.get('timing', '0') not in ('', '0')
+        self.written = 0
+        self.mismatches = 0
+        self._written_at = monotonic()
+        self._pos = 0
+        self._cancelled = False
+        self._cond = threading.Condition()
+        # for every RX chunk: end offset, TX bytes sent before it and the
+        # seconds since the last of them
+        tx_stamps = [stamp for offset, stamp in self.trace.tx_chunks]
+        self._chunks = []
+        rx_chunks = self.trace.rx_chunks
+        for i, (offset, stamp) in enumerate(rx_chunks):
+            end = rx_chunks[i + 1][0] if i + 1 < len(rx_chunks) else len(self.trace.rx)
+            j = bisect.bisect_right(tx_stamps, stamp)
+            need = self.trace.tx_chunks[j][0] if j < len(tx_stamps) else len(self.trace.tx)
+            self._chunks.append((end, need, stamp - tx_stamps[j - 1] if j else stamp))
+
+    def _available(self, now):
+        """(end of the readable RX data, monotonic() time more becomes readable)"""
+        end = self._pos
+        i = bisect.bisect_right(self.trace.rx_chunks, (self._pos, float('inf'))) - 1
+        for chunk_end, need, delay in self._chunks[max(i, 0):]:
+            if need > self.written:
+                return end, None
+            if self.timing and need == self.written and now < self._written_at + delay:
+                return end, self._written_at + delay
+            end = chunk_end
+        return end, None
+
+    @property
+    def in_waiting(self):
+        return self._available(monotonic())[0] - self._pos
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._pos = self._available(float('inf'))[0]
+
+    def cancel_read(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def clear_cancel_read(self):
+        with self._cond:
+            self._cancelled = False
+
+    def write(self, data):
+        data = bytes(data)
+        with self._cond:
+            expected = self.trace.tx[self.written:self.written + len(data)]
+            if data != expected:
+                if not self.mismatches:
+                    sys.stderr.write('--- replay: data sent differs from the trace at TX byte %d ---\n'
+                                     % self.written)
+                self.mismatches += 1
+            self.written += len(data)
+            self._written_at = monotonic()
+            self._cond.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        with self._cond:
+            while not self._cancelled:
+                now = monotonic()
+                end, ready_at = self._available(now)
+                if end - self._pos >= size:
+                    break
+                if deadline is not None:
+                    if now >= deadline:
+                        break
+                    ready_at = min(ready_at or deadline, deadline)
+                self._cond.wait(None if ready_at is None else ready_at - now)
+            self._cancelled = False
+            end = self._available(monotonic())[0]
+            data = bytes(self.trace.rx[self._pos:min(end, self._pos + size)])
+            self._pos += len(data)
+        return data
+#------------------------------------
+#
+# Low Latency
+#
+#------------------------------------
+
+# driver buffer sizes requested where the port supports it (Windows)
+LOW_LATENCY_BUFFER = 65536
+
+
+def ftdi_latency_timer(ser):
+    """the latency timer in ms of an FTDI adapter on Linux, None if unknown"""
+    path = '/sys/bus/usb-serial/devices/%s/latency_timer' % os.path.basename(
+        str(getattr(ser, 'port', '')))
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def set_low_latency(ser, enable=True):
+    """\
+    Set or clear ASYNC_LOW_LATENCY on a Linux serial port (for FTDI
+    adapters this also sets the latency timer to 1 ms). Returns False if
+    the port does not support it.
+    """
+    if not hasattr(ser, 'set_low_latency_mode'):
+        return False
+    try:
+        ser.set_low_latency_mode(enable)
+    except (ValueError, OSError) as e:
+        log.info('low latency mode: %s', e)
+        return False
+    return True
+
+
+def tune_low_latency(ser, verbose=0):
+    """\
+    Tune the port for short replies: low latency mode, no inter byte
+    timeout (VMIN and VTIME 0, reads return as soon as select() sees
+    data) and large driver buffers where the port supports setting them.
+    Prints what it did.
+    """
+    done = []
+    if set_low_latency(ser):
+        done.append('ASYNC_LOW_LATENCY')
+    else:
+        print("Warning: low latency mode is not supported on %s" % ser.name)
+    timer = ftdi_latency_timer(ser)
+    if timer is not None:
+        done.append('latency timer %d ms' % timer)
+    ser.interCharTimeout = None
+    done.append('no inter byte timeout')
+    if hasattr(ser, 'set_buffer_size'):
+        ser.set_buffer_size(rx_size=LOW_LATENCY_BUFFER, tx_size=LOW_LATENCY_BUFFER)
+        done.append('%d byte buffers' % LOW_LATENCY_BUFFER)
+    if verbose > 0:
+        print("Low latency: %s" % ', '.join(done))
+
+#------------------------------------
+#
+# Link Benchmark
+#
+#------------------------------------
+
+BENCH_SIZES = [1, 16, 64, 256, 1023, 4096, 16384]
+
+
+def percentile(samples, pct):
+    """linear interpolated percentile (0-100) of a sorted list"""
+    if not samples:
+        return 0.0
+    pos = (len(samples) - 1) * pct / 100.0
+    low = int(pos)
+    high = min(low + 1, len(samples) - 1)
+    return samples[low] + (samples[high] - samples[low]) * (pos - low)
+
+
+class LinkBenchmark(object):
+    """\
+    Measure the bootloader link: echo round trips for latency and jitter,
+    WRITE_MEM/READ_MEM transfers of increasing size for throughput.
+    """
+
+    def __init__(self, emc, address, count=20, sizes=BENCH_SIZES):
+        self.emc = emc
+        self.address = address
+        self.count = count
+        self.sizes = sizes
+
+    def echo_round_trips(self):
+        samples = []
+        for i in range(self.count):
+            value = bytes([(0x5A + i) & 0xFF])
+            start = perf_counter()
+            self.emc.write_bin_command(EMC_ECHO_COMMAND)
+            self.emc.write_bytes(value)
+            reply = self.emc.read_exact(1)
+            samples.append(perf_counter() - start)
+            if reply != value:
+                print("Error: echo returned %r instead of %r" % (reply, value))
+                sys.exit(1)
+        return sorted(samples)
+
+    def write_mem(self, payload):
+        """upload payload to the scratch address, returns the seconds until the ack"""
+        start = perf_counter()
+        resp = self.emc.write_mem(self.address, payload)
+        elapsed = perf_counter() - start
+        if resp != b'\x00':
+            print("Error: %s Failed Write Bytes in Memmory" % binascii.hexlify(resp))
+            sys.exit(1)
+        return elapsed
+
+    def read_mem(self, length):
+        """read length bytes from the scratch address, returns (seconds, data)"""
+        start = perf_counter()
+        data = self.emc.read_mem(self.address, length)
+        return perf_counter() - start, data
+
+    def transfers(self):
+        """returns {size: (write samples, read samples)}"""
+        results = {}
+        for size in self.sizes:
+            writes = []
+            reads = []
+            for i in range(self.count):
+                payload = os.urandom(size)
+                writes.append(self.write_mem(payload))
+                elapsed, data = self.read_mem(size)
+                if data != payload:
+                    print("Error: read back %d of %d bytes, %s" % (
+                        len(data), size,
+                        'data differs' if len(data) == size else 'timed out'))
+                    sys.exit(1)
+                reads.append(elapsed)
+            results[size] = (sorted(writes), sorted(reads))
+        return results
+
+    def print_round_trips(self, rtt, title='Round trip'):
+        mean = sum(rtt) / len(rtt)
+        jitter = (sum((s - mean) ** 2 for s in rtt) / len(rtt)) ** 0.5
+        print("--- %s (echo, %d samples)" % (title, len(rtt)))
+        print("    min %.3f ms  p50 %.3f ms  p90 %.3f ms  p99 %.3f ms  max %.3f ms" % tuple(
+            1000 * v for v in (rtt[0], percentile(rtt, 50), percentile(rtt, 90),
+                               percentile(rtt, 99), rtt[-1])))
+        print("    jitter (stdev) %.3f ms" % (1000 * jitter))
+
+    def run(self, baudrate=None, tune=None):
+        """\
+        tune, if given, is called between a first round trip measurement and
+        the rest, to show its effect
+        """
+        if tune is not None:
+            self.print_round_trips(self.echo_round_trips(), 'Round trip before tuning')
+            tune()
+            self.print_round_trips(self.echo_round_trips(), 'Round trip after tuning')
+        else:
+            self.print_round_trips(self.echo_round_trips())
+
+        results = self.transfers()
+        line_rate = baudrate / 10.0 if baudrate else None
+        for title, index in (("Host -> board (WRITE_MEM)", 0),
+                             ("Board -> host (READ_MEM)", 1)):
+            rates = dict((size, size / percentile(samples[index], 50))
+                         for size, samples in results.items())
+            top = max(rates.values())
+            print("--- %s, %d samples per size" % (title, self.count))
+            print("    %6s %9s %9s %9s %10s %6s" % (
+                'bytes', 'p50 ms', 'p90 ms', 'max ms', 'bytes/s', 'line%'))
+            for size in self.sizes:
+                samples = results[size][index]
+                print("    %6d %9.3f %9.3f %9.3f %10.0f %6s %s" % (
+                    size,
+                    1000 * percentile(samples, 50),
+                    1000 * percentile(samples, 90),
+                    1000 * samples[-1],
+                    rates[size],
+                    '%.0f' % (100 * rates[size] / line_rate) if line_rate else '-',
+                    '#' * int(round(30 * rates[size] / top))))
+
+#------------------------------------
+#
+# Execution Timing
+#
+#------------------------------------
+
+class ExecutionTimer(object):
+    """\
+    Time a program on the board: send EMC_EXECUTE_MEM, then timestamp the
+    first output and the start/end markers (regular expressions, see
+    TriggerEngine) in the output. Times are taken per serial read, markers
+    that arrive in the same read get the same time. The program has to
+    return to the bootloader after the end marker for the next run.
+    """
+
+    def __init__(self, emc, ifdata, start_marker=None, end_marker=None,
+                 reupload=False, timeout=10.0, verbose=0, policy=None,
+                 compress=None):
+        self.emc = emc
+        self.policy = policy
+        self.compress = compress
+        self.ifdata = ifdata
+        self.start_marker = start_marker
+        self.end_marker = end_marker
+        self.reupload = reupload
+        self.timeout = timeout
+        self.verbose = verbose
+
+    def run_once(self):
+        """execute once, returns {event: seconds after the execute command}"""
+        if self.reupload:
+            upload_to_memory(self.emc, self.ifdata, self.policy, self.compress)
+        ser = self.emc.serial
+        marks = {}
+        now = [0]
+        triggers = []
+        if self.start_marker:
+            triggers.append((self.start_marker,
+                             lambda text: marks.setdefault('start', now[0])))
+        if self.end_marker:
+            triggers.append((self.end_marker,
+                             lambda text: marks.setdefault('end', now[0])))
+        engine = TriggerEngine(triggers) if triggers else None
+
+        ser.reset_input_buffer()
+        self.emc.write_bin_block(EMC_EXECUTE_MEM_COMMAND,
+                                 num2le(self.ifdata.execAddress, 3))
+        ser.flush()
+        start = perf_counter()
+        deadline = start + self.timeout
+        while 'end' not in marks and perf_counter() < deadline:
+            data = ser.read(ser.in_waiting or 1)
+            now[0] = perf_counter()
+            if not data:
+                if not self.end_marker and 'first' in marks:
+                    break       # output went idle
+                continue
+            marks.setdefault('first', now[0])
+            if self.verbose > 0:
+                sys.stdout.write(data.decode('latin-1'))
+            if engine is not None:
+                engine.feed(data)
+        return dict((k, v - start) for k, v in marks.items())
+
+    def run(self, runs):
+        results = {'first': [], 'start': [], 'end': [], 'start -> end': []}
+        for i in range(runs):
+            marks = self.run_once()
+            if 'start' in marks and 'end' in marks:
+                marks['start -> end'] = marks['end'] - marks['start']
+            for k, v in marks.items():
+                results[k].append(v)
+            print("run %d: %s" % (i + 1, ', '.join(
+                '%s %.3f ms' % (k, 1000 * marks[k])
+                for k in ('first', 'start', 'end', 'start -> end') if k in marks) or
+                'no output'))
+            if self.end_marker and 'end' not in marks:
+                print("Error: end marker not seen within %g seconds" % self.timeout)
+        print("--- Execution timing, %d runs" % runs)
+        for k, title in (('first', 'execute -> first output'),
+                         ('start', 'execute -> start marker'),
+                         ('end', 'execute -> end marker'),
+                         ('start -> end', 'start -> end marker')):
+            samples = sorted(results[k])
+            if not samples:
+                continue
+            print("    %-24s n %-3d min %.3f ms  p50 %.3f ms  p90 %.3f ms  max %.3f ms" % (
+                (title, len(samples)) + tuple(1000 * v for v in (
+                    samples[0], percentile(samples, 50), percentile(samples, 90), samples[-1]))))
+        return results
+
+####################################
+#
+# Main Program Start
+#
+####################################
+
+note = """Example: script.py -d /dev/ttyUSB0 -x 1000 filename.bin\n
+		"""
+
+if __name__ == '__main__':
+    import argparse
+    from argparse import RawTextHelpFormatter
+
+    parser = argparse.ArgumentParser(
+        description='Upload file to board or execute some other command', epilog=note, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument(
+        'FILENAME',
+        nargs='*',
+        metavar='FILENAME[@ADDRESS]',
+        help='set the file name/path of the files to upload, files are linked into one image.\n'
+             'Binary files are loaded at ADDRESS (default -a), other files are moved there\n'
+             'only if ADDRESS is given',
+        default=[])
+
+    parser.add_argument(
+        '-b', '--baudrate',
+        type=int,
         action='store',
         help='set baud rate, default: %(default)s',
         default=115200)
@@ -1017,6 +4220,12 @@ if __name__ == '__main__':
         help='set for executing a read, write or execute command on flash default is memory',
         default=-False)
 
+    parser.add_argument(
+        '--flash-force',
+        action='store_true',
+        help='clear and write the flash even if it already holds the image',
+        default=False)
+
     parser.add_argument(
         '-d', '--device',
         action='store',
@@ -1025,15 +4234,16 @@ if __name__ == '__main__':
 
     parser.add_argument(
         '-a', '--address',
+        type=parse_address,
         action='store',
-        help='set the address for operation',
+        help='set the 24 bit address for operation, e.g. 012000, 0x012000 or 01:2000',
         default=None)
 
     parser.add_argument(
         '-l', '--length',
         type=int,
         action='store',
-        help='set the length for operation',
+        help='set the length for operation, in raw mode the expected reply length',
         default=0)
 
     parser.add_argument(
@@ -1042,11 +4252,52 @@ if __name__ == '__main__':
         help='send raw hex string to the device by setting the mode to raw',
         default=None)
 
+    parser.add_argument(
+        '--debug-log',
+        metavar='FILE',
+        help='write all diagnostics (one line per bootloader frame) to FILE instead of\n'
+             'only showing them on stderr with -v -v',
+        default=None)
+
+    parser.add_argument(
+        '--debug-json',
+        action='store_true',
+        help='write the diagnostics as JSON lines',
+        default=False)
+
+    parser.add_argument(
+        '--ascii',
+        action='store_true',
+        help='add an ASCII column to the hex dump of read mode',
+        default=False)
+
+    parser.add_argument(
+        '--hex-file',
+        metavar='FILE',
+        help='like --hex-string, read the hex bytes from FILE (- for stdin), # starts a comment',
+        default=None)
+
+    parser.add_argument(
+        '--until',
+        type=bytes.fromhex,
+        metavar='HEX',
+        help='in raw mode stop reading the reply after these hex bytes',
+        default=None)
+
+    parser.add_argument(
+        '--idle',
+        type=float,
+        metavar='MS',
+        help='in raw mode the reply ends after MS milliseconds without data, default: %(default)s',
+        default=50)
+
     parser.add_argument(
         '-m', '--mode',
         action='store',
         required=True,
-        help='set the mode of operation (read, write, clear, check, execute, update and raw)')
+        help='set the mode of operation (read, write, clear, check, execute, update, raw, bench-link, time\n'
+             'trace, which prints the bootloader frames in the trace files given as FILENAME,\n'
+             'and convert, which converts the first FILENAME to the second)')
 
     parser.add_argument(
         '-x', '--execute',
@@ -1068,12 +4319,167 @@ if __name__ == '__main__':
         help='Manually sync the device by giving a delay to press the reset button ',
         const=4)
 
+    parser.add_argument(
+        '--block-size',
+        type=FramePolicy,
+        metavar='SIZE',
+        help='size of the frames written to memory: N (fixed), max:N (at most N),\n'
+             'max (one frame per block) or auto (measured on the link),\n'
+             'default: from the board profile, usually max',
+        default=None)
+
+    parser.add_argument(
+        '--low-latency',
+        action='store_true',
+        help='tune the serial port for short replies (ASYNC_LOW_LATENCY on Linux,\n'
+             'no inter byte timeout), bench-link shows round trips before and after',
+        default=False)
+
+    parser.add_argument(
+        '--profiles',
+        metavar='FILE',
+        help='JSON file with more board profiles, a list of objects with the keys\n'
+             'board, cpu, hw, sw (to match the board info) and the settings\n'
+             'frames, baudrate, timeout, flash, flash_chunk, vectors, rtscts, low_latency\n'
+             'and name',
+        default=None)
+
+    parser.add_argument(
+        '--sparse',
+        type=parse_sparse,
+        metavar='FILL[:MIN]',
+        help='do not send runs of at least MIN (default 64) bytes of the hex value FILL,\n'
+             'for memory that already holds FILL there (or where the content does not matter),\n'
+             'memory uploads only',
+        default=None)
+
+    parser.add_argument(
+        '--compress',
+        type=parse_address,
+        metavar='ADDR',
+        help='send memory uploads LZ compressed and expand them on the board with a\n'
+             '%d byte decompressor stub written to free bank 0 RAM at ADDR, followed by\n'
+             'the compressed data (bank 0 blocks only, the others are sent as they are)' % len(
+                 DECOMPRESS_STUB),
+        default=None)
+
+    parser.add_argument(
+        '--verify',
+        type=parse_verify,
+        metavar='METHOD',
+        help='verify memory uploads: readback (read every byte back) or checksum:ADDR\n'
+             '(run a %d byte CRC stub from free bank 0 RAM at ADDR and read back only\n'
+             'the CRC, blocks outside bank 0 are read back)' % len(CHECKSUM_STUB),
+        default=None)
+
+    parser.add_argument(
+        '--to',
+        choices=sorted(CONVERT_FORMATS),
+        help='output format of convert mode, default: from the extension of the output file\n'
+             '(.hex/.ihx, .bin/.out, .s19/.s28/.s37/.srec/.mot, else zbin)',
+        default=None)
+
+    parser.add_argument(
+        '--fill',
+        type=lambda text: int(text, 16),
+        metavar='HEX',
+        help='byte filling the gaps of binary output in convert mode, default: FF',
+        default=0xFF)
+
+    parser.add_argument(
+        '--transport',
+        choices=['auto', 'pyserial', 'fd'],
+        help='how bootloader commands reach the port: pyserial, or fd (os.write/os.readv\n'
+             'on the port file descriptor, POSIX only), auto uses fd on Linux,\n'
+             'default: %(default)s',
+        default='auto')
+
+    parser.add_argument(
+        '--trace',
+        metavar='FILE',
+        help='record every byte sent and received with a timestamp to FILE, for -m trace\n'
+             'and for the replay://FILE[?timing=1] device',
+        default=None)
+
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='keep parsed files in a cache and reuse them while the file content is unchanged',
+        default=False)
+
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        help='directory of the parsed file cache, default: %(default)s',
+        default=default_cache_dir())
+
+    parser.add_argument(
+        '--cache-size',
+        type=parse_size,
+        metavar='SIZE',
+        help='maximum size of the parsed file cache (K, M and G suffixes allowed), default: 256M',
+        default=256 << 20)
+
     parser.add_argument(
         '-v', '--verbose',
         action='count',
         help='Switch on verbose to get debug messages',
         default=0)
 
+    group = parser.add_argument_group("link benchmark settings")
+
+    group.add_argument(
+        "--bench-count",
+        type=int,
+        metavar='N',
+        help="samples per measurement in bench-link mode, default: %(default)s",
+        default=20)
+
+    group.add_argument(
+        "--bench-sizes",
+        type=lambda s: [int(v, 0) for v in s.split(',')],
+        metavar='SIZES',
+        help="comma separated payload sizes for bench-link mode, default: %s" % ','.join(
+            str(s) for s in BENCH_SIZES),
+        default=BENCH_SIZES)
+
+    group = parser.add_argument_group("execution timing settings")
+
+    group.add_argument(
+        "--runs",
+        type=int,
+        metavar='N',
+        help="number of runs in time mode, default: %(default)s",
+        default=10)
+
+    group.add_argument(
+        "--start-marker",
+        type=parse_marker,
+        metavar='REGEX',
+        help="output that marks the start of the timed section in time mode\n"
+             "(multiline, ^ matches at line starts)",
+        default=None)
+
+    group.add_argument(
+        "--end-marker",
+        type=parse_marker,
+        metavar='REGEX',
+        help="output that marks the end of a run in time mode, without it a run ends when the output goes idle",
+        default=None)
+
+    group.add_argument(
+        "--reupload",
+        action="store_true",
+        help="upload the file again before every run in time mode",
+        default=False)
+
+    group.add_argument(
+        "--run-timeout",
+        type=float,
+        metavar='SECONDS',
+        help="give up waiting for the end of a run after SECONDS, default: %(default)s",
+        default=10.0)
+
     group = parser.add_argument_group("terminal settings")
 
     group.add_argument(
@@ -1121,6 +4527,73 @@ if __name__ == '__main__':
         help="end of line mode - Terminal Mode configuration option",
         default='CRLF')
 
+    group.add_argument(
+        "--rx-hold",
+        type=float,
+        metavar='MS',
+        help="collect received data for up to MS milliseconds before writing it to the console, 0 writes every read at once, default: %(default)s - Terminal Mode configuration option",
+        default=5)
+
+    group.add_argument(
+        "--event-loop",
+        action="store_true",
+        help="run the terminal in a single thread using a selector (POSIX serial ports only) - Terminal Mode configuration option",
+        default=False)
+
+    group.add_argument(
+        "--log",
+        metavar='FILE',
+        help="record the data received in terminal mode to FILE - Terminal Mode configuration option",
+        default=None)
+
+    group.add_argument(
+        "--log-tx",
+        action="store_true",
+        help="record sent data in the log as well - Terminal Mode configuration option",
+        default=False)
+
+    group.add_argument(
+        "--log-timestamps",
+        action="store_true",
+        help="write a binary log with a direction and a monotonic timestamp for every chunk - Terminal Mode configuration option",
+        default=False)
+
+    group.add_argument(
+        "--log-max-size",
+        type=parse_size,
+        metavar='SIZE',
+        help="rotate the log when it reaches SIZE bytes (K, M and G suffixes allowed), 0 never rotates, default: %(default)s - Terminal Mode configuration option",
+        default=0)
+
+    group.add_argument(
+        "--log-backups",
+        type=int,
+        metavar='N',
+        help="number of rotated logs to keep, default: %(default)s - Terminal Mode configuration option",
+        default=5)
+
+    group.add_argument(
+        "--log-compress",
+        action="store_true",
+        help="gzip rotated logs - Terminal Mode configuration option",
+        default=False)
+
+    group.add_argument(
+        "--on",
+        nargs=2,
+        action="append",
+        dest="triggers",
+        metavar=("REGEX", "ACTION"),
+        help="run ACTION when REGEX matches the received data: exit[:CODE], send:TEXT, upload or dump:ADDR:LEN - Terminal Mode configuration option",
+        default=[])
+
+    group.add_argument(
+        "--timeout",
+        type=float,
+        metavar='SECONDS',
+        help="leave the terminal with exit code 124 after SECONDS - Terminal Mode configuration option",
+        default=None)
+
     group.add_argument(
         "--exit-char",
         type=int,
@@ -1136,9 +4609,58 @@ if __name__ == '__main__':
         default=0x14)  # Menu: CTRL+T
 
     args = parser.parse_args()
+    setup_logging(args.verbose, args.debug_log, args.debug_json)
+
+    profile_entries = []
+    if args.profiles:
+        try:
+            profile_entries = load_profiles(args.profiles)
+        except (OSError, ValueError, TypeError) as e:
+            print("Error: %s: %s" % (args.profiles, e))
+            sys.exit(1)
 
     if args.menu_char == args.exit_char:
         parser.error('--exit-char can not be thesame as --menu-char')
+    if args.mode == 'trace':
+        for filename in args.FILENAME:
+            try:
+                print_trace(filename)
+            except (OSError, ValueError) as e:
+                print("Error: %s" % e)
+                sys.exit(1)
+        sys.exit(0)
+    if args.mode == 'convert':
+        if len(args.FILENAME) != 2:
+            print("Error: convert mode needs an input and an output file")
+            sys.exit(1)
+        infile, address = split_file_spec(args.FILENAME[0])
+        if address is None:
+            address = args.address or 0
+        try:
+            source, kind, writer = convert_image(infile, args.FILENAME[1], args.to,
+                                                 address, args.fill)
+        except (OSError, ValueError) as e:
+            print("Error: %s" % e)
+            sys.exit(1)
+        print("Converted %s (%s) to %s (%s): %d bytes in %d blocks" % (
+            infile, source, args.FILENAME[1], kind, writer.length, writer.blocks))
+        if kind == 'bin' and writer.first is not None:
+            print("The binary starts at address 0x%06X" % writer.first)
+        sys.exit(0)
+    trigger_actions = []
+    for pattern, spec in args.triggers:
+        try:
+            re.compile(pattern.encode('utf-8'), re.MULTILINE)
+            trigger_actions.append(parse_trigger_action(spec))
+        except (re.error, ValueError) as e:
+            parser.error('--on {} {}: {}'.format(pattern, spec, e))
+    try:
+        # each pattern may be fine on its own but not in the combined regex
+        trigger_regex([pattern.encode('utf-8') for pattern, spec in args.triggers])
+    except re.error as e:
+        parser.error('--on: {}'.format(e))
+        if spec == 'upload' and (args.mode != 'write' or args.flash):
+            parser.error('the upload trigger action needs write mode to memory')
     if args.filter:
         if 'help' in args.filter:
             sys.stderr.write('Available filters:\n')
@@ -1188,21 +4710,17 @@ if __name__ == '__main__':
             print("Sorry, No available serial port found")
             sys.exit(0)
 
-    if args.address is not None:
-        if len(args.address) == 6:
-            if int('0x'+args.address[2:], 16) > int('0xFFFF', 16):
-                print("Error: Address must be less than 0xFFFF")
-                sys.exit(1)
-            else:
-                args.address = args.address[4:] + \
-                    args.address[2:4]+args.address[:2]
-        else:
-            print(
-                "Error: Invalid value. The address must be 6 hexadecimal characters in the form BBAAAA")
-            sys.exit(1)
-
     # connect to serial port
-    ser = serial.serial_for_url(args.device, do_not_open=True)
+    if args.device.startswith('sim://'):
+        ser = EMCBoardSim(args.device)
+    elif args.device.startswith('replay://'):
+        try:
+            ser = TraceReplay(args.device)
+        except (OSError, ValueError) as e:
+            print("Error: %s" % e)
+            sys.exit(1)
+    else:
+        ser = serial.serial_for_url(args.device, do_not_open=True)
     ser.baudrate = args.baudrate
     ser.parity = 'N'
     ser.rtscts = True
@@ -1222,6 +4740,24 @@ if __name__ == '__main__':
     if args.verbose > 0:
         print("Serial %s port opened" % (ser.name))
 
+    # what EMCSerial talks through, the terminal keeps using pyserial
+    transport = ser
+    if args.transport == 'fd' or (args.transport == 'auto' and
+                                  sys.platform.startswith('linux')):
+        if FdTransport.usable(ser):
+            transport = FdTransport(ser)
+        elif args.transport == 'fd':
+            print("Error: the fd transport needs a local serial port on a POSIX system")
+            sys.exit(1)
+    log.debug('transport %s', type(transport).__name__)
+
+    if args.trace:
+        trace_log = SessionLog(args.trace, tx=True, timestamps=True)
+        # written out when the script exits, wherever that happens
+        atexit.register(trace_log.close)
+        ser = TracedSerial(ser, trace_log)
+        transport = TracedSerial(transport, trace_log)
+
     if not args.no_reset:
         if args.verbose > 0:
             print("Resetting the device")
@@ -1234,12 +4770,13 @@ if __name__ == '__main__':
         if args.verbose > 0:
             print("Device has been reset")
 
-    emcSerial = EMCSerial(ser, args.verbose)
+    emcSerial = EMCSerial(transport, args.verbose)
 
-    bytes = ''
     content = ''
     first_char = ''
     address = 0
+    exit_code = 0
+    capture = None
 
     if args.sync:
         print("Press the RESET Button")
@@ -1250,48 +4787,67 @@ if __name__ == '__main__':
         if emcSerial.separate_hex(data) == '00':
             print("Synced Successfully")
 
-    if args.FILENAME is not None:
-        if os.path.isfile(args.FILENAME):
-            with open(args.FILENAME, 'rb') as f:
-                content = f.read()
-                ifdata = parse_infile(content)
-                # fix for flash
-                # bytes = binascii.hexlify(content)
-                # byte_array = [bytes[i:i+2].decode('utf-8')
-                #               for i in range(0, len(bytes), 2)]
-                # # Strip the leadin Z
-                # byte_array = byte_array[1:]
-
-
-
-                #first_char = content[0]
-                #if first_char == 'Z':
-
-                #     print("Error: File is not a Z-bin file")
-                #     sys.exit(1)
-        else:
-            print("Error: File %s does not exist" % args.FILENAME)
+    ifdata = None
+    files = [split_file_spec(spec) for spec in args.FILENAME]
+    filenames = ', '.join(filename for filename, address in files)
+    if files:
+        cache = None
+        if args.cache:
+            cache = ImageCache(args.cache_dir, args.cache_size, args.verbose)
+        images = []
+        for filename, address in files:
+            if not os.path.isfile(filename):
+                print("Error: File %s does not exist" % filename)
+                sys.exit(1)
+            if address is None and is_binary(filename):
+                # other formats only move for an explicit FILENAME@ADDRESS
+                address = args.address
+            images.append((filename, load_infile(filename, address, cache)))
+        ifdata = link_images(images, args.verbose)
+        if args.sparse is not None and args.mode == "update":
+            # the update image is sent whole, skipped runs would become 00
+            print("Error: --sparse only applies to uploads to memory, not to update mode")
             sys.exit(1)
+        if args.sparse is not None and not args.flash:
+            total = sum(block.length for block in ifdata.blocks)
+            ifdata.blocks, skipped, runs = sparse_blocks(ifdata.blocks, *args.sparse)
+            print("Sparse upload: skipping %d of %d bytes (%.1f%%) in %d runs of 0x%02X" % (
+                skipped, total, 100.0 * skipped / total if total else 0, runs, args.sparse[0]))
 
 
     if args.mode == "raw":
-        if args.hex_string is not None:
-            raw_data = args.hex_string.split(' ')
-            for i in range(0, len(raw_data)):
-                var_var = emcSerial.write_serial(raw_data[i])
-                # print(emcSerial.separate_hex(emcSerial.read_serial()))
-            sleep(1)
-            print(emcSerial.separate_hex(emcSerial.read_serial()))
-        else:
+        text = args.hex_string
+        if args.hex_file is not None:
+            try:
+                if args.hex_file == '-':
+                    text = sys.stdin.read()
+                else:
+                    with open(args.hex_file) as f:
+                        text = f.read()
+            except OSError as e:
+                print("Error: %s" % e)
+                sys.exit(1)
+            text = ' '.join(line.partition('#')[0] for line in text.splitlines())
+        if text is None:
             print("Error: you must provide the hex string e.g 55 aa 00 20 ....")
-        sys.exit(1)
+            sys.exit(1)
+        try:
+            raw_data = bytes.fromhex(text)
+        except ValueError as e:
+            print("Error: invalid hex string, %s" % e)
+            sys.exit(1)
+        emcSerial.write_bytes(raw_data)
+        reply = emcSerial.read_reply(args.length, args.until, args.idle / 1000.0)
+        print(binascii.hexlify(reply, ' ').decode().upper())
+        sys.exit(0 if reply else 1)
 
     emcSerial.write_bin_command(EMC_BOARD_INFO_COMMAND)
-    data = emcSerial.read_serial_raw()
-    if (data is not None and data != '' and len(data) == 12):
+    data = emcSerial.read_reply(12)
+    profile = select_profile(entries=profile_entries)
+    if len(data) == 12:
         known = False
         if chr(data[0]) == 'M' and chr(data[1]) == 'Y':
-            know = True
+            known = True
             if   chr(data[2]) == 'A':
                 print("Board Type: Mymensch A Board")
             elif chr(data[2]) == 'B':
@@ -1308,18 +4864,22 @@ if __name__ == '__main__':
             print("Running WDC Bootloader")
             if   chr(data[3]) == '2':
                 print("CPU Type: W65C02 - ", end='')
-                Board_Type = '2'
             elif chr(data[3]) == '6':
                 print("CPU Type: W65C816 - ", end='')
-                Board_Type = '6'
             else:
                 print("Unknown CPU Type - ", end='')
-                Board_Type = '0'
-            hw_version = int.from_bytes(data[4:8], 'little')/100
-            sw_version = int.from_bytes(data[8:12], 'little')/100
-            print("Hardware version: {}, Software Version: {}".format(hw_version, sw_version))
+            hw = int.from_bytes(data[4:8], 'little')
+            sw = int.from_bytes(data[8:12], 'little')
+            print("Hardware version: {}, Software Version: {}".format(hw / 100, sw / 100))
+            profile = select_profile(data[:3].decode('latin-1'), chr(data[3]), hw, sw,
+                                     profile_entries)
+            print("Board profile: %s" % profile.name)
     else:
         print("Error: Unable to get Board Info")
+    profile.apply(args, ser)
+    low_latency = args.low_latency or profile.low_latency
+    if low_latency and args.mode != "bench-link":
+        tune_low_latency(ser, args.verbose)
 
     if args.mode == "clear":
         print("Clearing flash...")
@@ -1346,14 +4906,41 @@ if __name__ == '__main__':
             print("Executing program at address 0x00 in flash")
             emcSerial.write_bin_command(EMC_EXECUTE_FLASH_COMMAND)
         elif args.address is not None:
-            addr = [args.address[i:i+2]
-                    for i in range(0, len(args.address), 2)]
-            print("Executing program at address %s in memory" % args.address)
-            emcSerial.write_bin_block(EMC_EXECUTE_MEM_COMMAND, addr)
+            print("Executing program at address 0x%06X in memory" % args.address)
+            emcSerial.write_bin_block(EMC_EXECUTE_MEM_COMMAND, num2le(args.address, 3))
         else:
             print("Error: you must provide the address where the code will be executed from in memory or -f for flash")
             sys.exit(1)
 
+    elif args.mode == "bench-link":
+        address = 0x001000
+        if args.address is not None:
+            address = args.address
+        print("Benchmarking link on %s at %d baud, scratch memory at 0x%06X" % (
+            ser.name, ser.baudrate, address))
+        tune = None
+        if low_latency:
+            set_low_latency(ser, False)
+            tune = lambda: tune_low_latency(ser, 1)
+        LinkBenchmark(emcSerial, address, args.bench_count,
+                      args.bench_sizes).run(ser.baudrate, tune)
+
+    elif args.mode == "time":
+        if not args.FILENAME or args.flash:
+            print("Error: time mode needs the file to upload to memory")
+            sys.exit(1)
+        print("Writing contents of %s to memory..." % (filenames))
+        upload_to_memory(emcSerial, ifdata, args.block_size, args.compress)
+        if args.verify:
+            verify_memory(emcSerial, ifdata, *args.verify)
+        print("Timing program at address 0x%06X, %d runs" % (ifdata.execAddress, args.runs))
+        ExecutionTimer(
+            emcSerial, ifdata,
+            args.start_marker and args.start_marker.encode('utf-8'),
+            args.end_marker and args.end_marker.encode('utf-8'),
+            args.reupload, args.run_timeout, args.verbose, args.block_size,
+            args.compress).run(args.runs)
+
     elif args.mode == "read":
         address = 0
         if not args.flash:
@@ -1362,18 +4949,8 @@ if __name__ == '__main__':
                     "Error: you must provide the address and the length with which to read from")
                 sys.exit(1)
             print("Reading from memory...")
-            addr = args.address
-            leng = hex(args.length)[2:]
-            if len(addr) < 6:
-                for i in range(len(addr), 6):
-                    addr = '0'+addr
-            if len(leng) < 6:
-                for i in range(len(leng), 6):
-                    leng = '0'+leng
-            addr = [addr[4:], addr[2:4], addr[:2]]
-            leng = [leng[4:], leng[2:4], leng[:2]]
-            emcSerial.write_bin_block(EMC_READ_MEM_COMMAND, addr, leng)
-            address = int("0x"+addr[2]+addr[1]+addr[0], 16)
+            address = args.address
+            chunks = emcSerial.read_mem_chunks(address, args.length)
         else:
             if args.length < 1:
                 print("Error: you must provide the length of data to read")
@@ -1391,170 +4968,92 @@ if __name__ == '__main__':
             leng = [leng[4:], leng[2:4], leng[:2]]
             emcSerial.write_bin_block(EMC_READ_FLASH_COMMAND, addr, leng)
             address = int("0x"+addr[2]+addr[1]+addr[0], 16)
-        data = emcSerial.read_serial()
-        inf = emcSerial.separate_hex(data)
-        for i in range(0, len(inf), 48):
-            print("%s:\t%s" % (hex(address)[2:].upper(), inf[i:i+48]))
-            address += 16
+            chunks = emcSerial.read_chunks(args.length)
+        for line in hexdump(chunks, address, ascii=args.ascii):
+            print(line)
 
     elif args.mode == "write":
-        if args.FILENAME is None:
+        if not args.FILENAME:
             print(
                 "Error: you must provide the path for the .bin file if you want to write data to board")
             sys.exit(1)
 
         if not args.flash:
-            print("Writing contents of %s to memory..." % (args.FILENAME))
-            i = 0
-            for block in ifdata.blocks:
-                emcSerial.write_bin_block(
-                    EMC_WRITE_MEM_COMMAND,
-                    num2le(block.address, 3),
-                    num2le(block.length, 3),
-                    block.data)
-
-                resp = emcSerial.separate_hex(emcSerial.read_serial())
-                if resp != '00':
-                    print("Error: %s Failed Write Bytes in Memmory" % resp)
-                    sys.exit(0)
+            print("Writing contents of %s to memory..." % (filenames))
+            upload_to_memory(emcSerial, ifdata, args.block_size, args.compress)
+            if args.verify:
+                verify_memory(emcSerial, ifdata, *args.verify)
 
             if args.execute:
-                addrs = num2le(ifdata.execAddress, 3)
-                print("\nExecuting program at address 0x%s in memory" % ''.join(addrs))
-                emcSerial.write_bin_block(EMC_EXECUTE_MEM_COMMAND, num2le(ifdata.execAddress, 3))
+                capture = execute_memory(emcSerial, ifdata.execAddress, args.terminal)
 
         else:
-            if byte_array[1].upper() != '80' or byte_array[0].upper() != '00':
-                print("Error: the start address in the bin file does not match 0x8000")
-                sys.exit(1)
-
-            addr = ['00', '00', '00']
-
-            print("Clearing flash...")
-            emcSerial.write_bin_command(EMC_CLEAR_FLASH_COMMAND)
-            data = emcSerial.separate_hex(emcSerial.read_serial())
-            if data == "00":
-                print("\nCleared Successfully")
+            image = flash_image(ifdata, profile.flash)
+            # reads at offsets and resuming need a bootloader that takes
+            # several write frames
+            if args.flash_force:
+                offset = None
+            elif profile.flash_chunk:
+                offset = flash_resume(emcSerial, image)
             else:
-                print("\nClear Failed")
-                sys.exit(1)
-
-            print("Writing contents of %s to flash..." % (args.FILENAME))
-
-            blocks = {}
-            block_data = ['00'] * 32768
-            prev_add = None
-            address = 0
-            length = 0
-            while byte_array:
-                # print byte_array;
+                offset = len(image) if flash_holds(emcSerial, image) else None
+            if offset == len(image):
+                print("Flash already holds the contents of %s, skipping clear and write" % (
+                    filenames))
+            else:
+                if offset is None:
+                    print("Clearing flash...")
+                    emcSerial.write_bin_command(EMC_CLEAR_FLASH_COMMAND)
+                    data = emcSerial.separate_hex(emcSerial.read_serial())
+                    if data == "00":
+                        print("\nCleared Successfully")
+                    else:
+                        print("\nClear Failed")
+                        sys.exit(1)
+                    offset = 0
+                elif offset:
+                    print("Flash holds 0x%06X-0x%06X already, resuming there" % (
+                        FLASH_START, FLASH_START + offset - 1))
 
-                if int("0x" + byte_array[:3][2] + byte_array[:3][1] + byte_array[:3][0], 16) < int("0x8000", 16):
-                    break
-                address = byte_array[:3]
-                byte_array = byte_array[3:]
-                length = "0x"+byte_array[:3][2] + \
-                    byte_array[:3][1]+byte_array[:3][0]
-                byte_array = byte_array[3:]
-                length = int(length, 16)
-                data = byte_array[:length]
-                byte_array = byte_array[length:]
-                current_pos = int(
-                    "0x" + address[2] + address[1] + address[0], 16) - int("0x8000", 16)
-                for i in range(current_pos, (current_pos+length)):
-                    block_data[i] = data[i-current_pos]
+                print("Writing contents of %s to flash..." % (filenames))
 
-            if address == 0 and length == 0:
-                print("Error occured")
-                sys.exit(1)
+                if args.verbose > 0:
+                    print("Data => ")
+                    for line in hexdump(image[offset:], FLASH_START + offset):
+                        print(line)
+                    print("\n")
 
-            final_length = int(
-                "0x" + address[2] + address[1] + address[0], 16) - int("0x8000", 16) + length
-            block_data = block_data[:final_length]
-            fhex = hex(final_length)[2:]
-
-            if len(fhex) < 6:
-                for i in range(len(fhex), 6):
-                    fhex = '0'+fhex
-
-            if args.verbose > 0:
-                print("Data => ")
-                s = ' '.join(block_data)
-                s = s.upper()
-                addr = int("0x8000", 16)
-                for i in range(0, len(s), 48):
-                    print("%s:\t%s" % (hex(addr)[2:].upper(), s[i:i+48]))
-                    addr += 16
-                print("\n")
-
-            emcSerial.write_bin_block(EMC_WRITE_FLASH_COMMAND, ["00", "80", "00"], [
-                                      fhex[4:], fhex[2:4], fhex[:2]], block_data)
-
-            sleep(2)
-
-            data = emcSerial.separate_hex(emcSerial.read_serial())
-            #data = emcSerial.read_serial()
-            if data == "00":
+                flash_program(emcSerial, image, offset, profile.flash_chunk)
                 print("Written Successfully")
-            else:
-                print("\nWrite Failed")
-                sys.exit(1)
 
             if args.execute:
                 print("Executing program at address 0x00 in flash")
                 emcSerial.write_bin_command(EMC_EXECUTE_FLASH_COMMAND)
 
     elif args.mode == "update":
-        if args.FILENAME is None:
+        if not args.FILENAME:
             print(
                 "Error: you must provide the path for the .bin file if you want to write data to board")
             sys.exit(1)
 
-        print("Writing contents of %s to memory..." % (args.FILENAME))
+        print("Writing contents of %s to memory..." % (filenames))
 
-        i = 0
-        addr = ['00', '00', '00']
-        blocks = {}
-        block_data = ['00'] * 65536
-        prev_add = None
-        address = 0
-        length = 0
-        while byte_array:
-            address = byte_array[:3]
-            byte_array = byte_array[3:]
-            length = "0x"+byte_array[:3][2]+byte_array[:3][1]+byte_array[:3][0]
-            byte_array = byte_array[3:]
-            length = int(length, 16)
-            # print(length)
-            data = byte_array[:length]
-            # print(data)
-            byte_array = byte_array[length:]
-            # print(byte_array)
-            current_pos = int("0x" + address[2] + address[1] + address[0], 16)
-            for i in range(current_pos, (current_pos+length)):
-                block_data[i] = data[i-current_pos]
-
-        if (Board_Type == '2'):
-
-            if ((block_data[0xFFFA] == '00' and block_data[0xFFFB] == '00') or 
-                (block_data[0xFFFC] == '00' and block_data[0xFFFD] == '00') or
-                (block_data[0xFFFE] == '00' and block_data[0xFFFF] == '00')):
-                print ("Error Vectors are Zero")
+        image = bytearray(0x10000)
+        for block in ifdata.blocks:
+            if block.address + block.length > 0x10000:
+                print("Error: the update image must be in bank 0")
                 sys.exit(1)
+            image[block.address:block.address + block.length] = binascii.unhexlify(
+                ''.join(block.data))
+        h = image.hex()
+        block_data = [h[i:i + 2] for i in range(0, len(h), 2)]
 
-        elif (Board_Type == '6'):
-
-            if ((block_data[0xFFF4] == '00' and block_data[0xFFF5] == '00') or 
-                (block_data[0xFFF6] == '00' and block_data[0xFFF7] == '00') or
-                (block_data[0xFFF8] == '00' and block_data[0xFFF9] == '00') or
-                (block_data[0xFFFA] == '00' and block_data[0xFFFB] == '00') or 
-                (block_data[0xFFFC] == '00' and block_data[0xFFFD] == '00') or
-                (block_data[0xFFFE] == '00' and block_data[0xFFFF] == '00')):
-                print ("Error Vectors are Zero")
-                sys.exit(1)
-        else:
+        if not profile.vectors:
             print ("Error No Board Type Identified")
             sys.exit(1)
+        if any(block_data[v] == '00' and block_data[v + 1] == '00' for v in profile.vectors):
+            print ("Error Vectors are Zero")
+            sys.exit(1)
 
         for i in range(0, 0xEFFF+1):
             if (block_data[i] != '00'):
@@ -1565,10 +5064,7 @@ if __name__ == '__main__':
         block_data = block_data[0xF000:]
 
         if args.verbose > 0:
-            if (Board_Type == '2'):
-                print (block_data[0x0FFA:0x0FFF+1])
-            elif (Board_Type == '6'):
-                print (block_data[0x0FF4:0x0FFF+1])
+            print (block_data[min(profile.vectors) - 0xF000:])
 
             print (hex(0xFFFF - len(block_data) + 1))
         if args.verbose > 1:
@@ -1631,14 +5127,39 @@ if __name__ == '__main__':
         sys.exit(0)
 
     if args.terminal:
+        session_log = None
+        if args.log:
+            session_log = SessionLog(
+                args.log,
+                tx=args.log_tx,
+                timestamps=args.log_timestamps,
+                max_bytes=args.log_max_size,
+                backups=args.log_backups,
+                compress=args.log_compress)
         miniterm = Miniterm(
             ser,
             echo=args.echo,
             eol=args.eol.lower(),
-            filters=filters)
+            filters=filters,
+            log=session_log,
+            # triggers and --timeout can run without anyone at the keyboard
+            console=HeadlessConsole() if (args.triggers or args.timeout is not None) and
+            not sys.stdin.isatty() else None)
         miniterm.exit_character = unichr(args.exit_char)
         miniterm.menu_character = unichr(args.menu_char)
         miniterm.raw = args.raw
+        miniterm.rx_flush_time = args.rx_hold / 1000.0
+        if args.triggers:
+            miniterm.triggers = TriggerEngine(
+                (pattern.encode('utf-8'),
+                 make_trigger_action(name, value, miniterm, emcSerial,
+                                     ifdata, args.execute, args.block_size,
+                                     args.compress))
+                for (pattern, spec), (name, value) in zip(args.triggers, trigger_actions))
+        if args.timeout is not None:
+            timer = threading.Timer(args.timeout, miniterm.quit, [124])
+            timer.daemon = True
+            timer.start()
         miniterm.set_rx_encoding(args.serial_port_encoding)
         miniterm.set_tx_encoding(args.serial_port_encoding)
 
@@ -1651,15 +5172,37 @@ if __name__ == '__main__':
                 key_description(miniterm.menu_character),
                 key_description('\x08')))
 
-        miniterm.start()
-        try:
-            miniterm.join(True)
-        except KeyboardInterrupt:
+        if capture is not None:
+            # replay what the program printed while the terminal was set up
+            for stamp, data in capture.stop():
+                miniterm.handle_rx(data, stamp)
+
+        if args.event_loop and not miniterm.selector_supported():
+            sys.stderr.write('--- event loop not supported on {}, using threads ---\n'.format(
+                ser.name))
+            args.event_loop = False
+
+        if miniterm.alive is False:
+            # a trigger ended the session while replaying the captured data
             pass
-        if not args.quiet:
-            sys.stderr.write("\n--- exit ---\n")
-        miniterm.join()
+        elif args.event_loop:
+            try:
+                miniterm.run_selector()
+            except KeyboardInterrupt:
+                pass
+            if not args.quiet:
+                sys.stderr.write("\n--- exit ---\n")
+        else:
+            miniterm.start()
+            try:
+                miniterm.join(True)
+            except KeyboardInterrupt:
+                pass
+            if not args.quiet:
+                sys.stderr.write("\n--- exit ---\n")
+            miniterm.join()
         miniterm.close()
+        exit_code = miniterm.exit_code
 
     ser.close()
-    sys.exit(0)
+    sys.exit(exit_code)